@@ -1,12 +1,21 @@
 """
 Block ciphers, key recovery, and hash functions
 """
+import os
+import time
+import multiprocessing
 from playcrypt.primitives import *
 from playcrypt.tools import *
 from playcrypt.ideal.function_family import *
 from playcrypt.games.game_cr import GameCR
 from playcrypt.simulator.cr_sim import CRSim
 from playcrypt.ideal.block_cipher import BlockCipher
+from trial_runner import run_trials, Estimate
+from sweep import sweep
+from instrument import instrument_globals, instrument_game, dump
+from randomness import random_string, use, CounterPRG, SEED
+from compact_cipher import CompactBlockCipher, DENSE_MAX_BYTES
+from oracle_cache import cached, clear_on_initialize, report
 
 
 """
@@ -170,6 +179,363 @@ def A2(K):
 
     return None, None
 
+"""
+    Block engine. The functions below compute the same outputs as Enc, Dec,
+    H1 and H2, but read each block straight out of one bytes copy of the
+    input, XOR blocks as integers, and write ciphertext blocks into a
+    preallocated buffer. No list of blocks is built, and H1/H2 keep only
+    the chaining value. F and E are still called on strings, as the ideal
+    primitives expect.
+"""
+
+def to_int(s):
+    return int.from_bytes(s.encode("latin-1"), "big")
+
+def to_block(x, size):
+    return x.to_bytes(size, "big").decode("latin-1")
+
+def Enc_fast(K, M):
+    """
+    Same as Enc.
+
+    :param K: blockcipher key
+    :param M: plaintext message
+    :return: ciphertext
+    """
+    n = n_bytes
+    data = memoryview(M.encode("latin-1"))
+    R = [random_string(n) for i in range(2)]
+    out = bytearray(len(data) + 2 * n)
+    out[:2 * n] = (R[0] + R[1]).encode("latin-1")
+    R = [to_int(R[0]), to_int(R[1])]
+    d = R[1] & 1
+    prev = 0
+    for i in range(0, len(data), n):
+        Mi = int.from_bytes(data[i:i + n], "big")
+        Ci = to_int(F(K, to_block(R[d] ^ prev, n))) ^ Mi
+        out[2 * n + i:3 * n + i] = Ci.to_bytes(n, "big")
+        d = Ci & 1
+        prev = Mi
+    return out.decode("latin-1")
+
+"""
+    The selector d[i] of Dec is the low bit of the last byte of R1 (i = 0)
+    or of ciphertext block i, so all of them are read from the ciphertext
+    in one pass before any F evaluation. Only the chaining through M[i-1]
+    is left in the loop.
+"""
+
+LSB = bytes(b & 1 for b in range(256))
+
+def selector_bits(data, n):
+    """
+    :param data: ciphertext bytes R0 || R1 || C1 || ... || Cm
+    :param n: block length in bytes
+    :return: bytes whose entry i is the selector d[i] for block i + 1
+    """
+    return data[2 * n - 1::n].translate(LSB)
+
+def Dec_fast(K, C):
+    """
+    Same as Dec.
+
+    :param K: blockcipher key
+    :param C: ciphertext
+    :return: plaintext message
+    """
+    n = n_bytes
+    data = C.encode("latin-1")
+    d = selector_bits(data, n)
+    R = (int.from_bytes(data[:n], "big"), int.from_bytes(data[n:2 * n], "big"))
+    out = bytearray(len(data) - 2 * n)
+    prev = 0
+    for i in range(len(out) // n):
+        Mi = to_int(F(K, to_block(R[d[i]] ^ prev, n))) ^ int.from_bytes(data[(i + 2) * n:(i + 3) * n], "big")
+        out[i * n:(i + 1) * n] = Mi.to_bytes(n, "big")
+        prev = Mi
+    return out.decode("latin-1")
+
+def H1_chain(K, h, data):
+    """
+    :param h: chaining value, as an integer
+    :param data: bytes-like input, a multiple of l_bytes long
+    :return: the chaining value after H1 has absorbed data
+    """
+    for i in range(0, len(data), l_bytes):
+        h = to_int(E(K, to_block(h ^ int.from_bytes(data[i:i + l_bytes], "big"), l_bytes)))
+    return h
+
+def H2_chain(K, h, data):
+    """
+    :param h: chaining value, as an integer
+    :param data: bytes-like input, a multiple of l_bytes long
+    :return: the chaining value after H2 has absorbed data
+    """
+    for i in range(0, len(data), l_bytes):
+        B = int.from_bytes(data[i:i + l_bytes], "big")
+        w = to_int(E(K, to_block(h ^ B, l_bytes)))
+        h = to_int(E(K, to_block(w ^ B, l_bytes)))
+    return h
+
+def H1_fast(K, M):
+    """
+    Same as H1, keeping only the chaining value.
+    """
+    return to_block(H1_chain(K, 0, memoryview(M.encode("latin-1"))), l_bytes)
+
+def H2_fast(K, M):
+    """
+    Same as H2, keeping only the chaining value.
+    """
+    return to_block(H2_chain(K, 0, memoryview(M.encode("latin-1"))), l_bytes)
+
+class H1Hasher(object):
+    """
+    Incremental H1 in the style of hashlib. Input may arrive in chunks of
+    any size; only a partial block and the chaining value are kept.
+    """
+
+    chain = staticmethod(H1_chain)
+
+    def __init__(self, K, M=""):
+        """
+        :param K: Key used by the hash function, must be of size k_bytes
+        :param M: optional first chunk of the message
+        """
+        self.K = K
+        self.h = 0
+        self.buffer = b""
+        self.update(M)
+
+    def update(self, chunk):
+        """
+        :param chunk: next part of the message, as a string or bytes
+        """
+        if isinstance(chunk, str):
+            chunk = chunk.encode("latin-1")
+        data = self.buffer + chunk
+        full = len(data) - len(data) % l_bytes
+        self.h = self.chain(self.K, self.h, memoryview(data)[:full])
+        self.buffer = data[full:]
+        return self
+
+    def copy(self):
+        other = object.__new__(type(self))
+        other.K, other.h, other.buffer = self.K, self.h, self.buffer
+        return other
+
+    def digest(self):
+        """
+        :return: the hash of everything passed to update so far
+        """
+        if self.buffer:
+            raise ValueError("Message length must be a multiple of l_bytes.")
+        return to_block(self.h, l_bytes)
+
+class H2Hasher(H1Hasher):
+    """
+    Incremental H2 in the style of hashlib.
+    """
+
+    chain = staticmethod(H2_chain)
+
+def throughput(fn, K, M, repeat=3):
+    """
+    :param fn: one of Enc, Dec, H1, H2 or their _fast versions
+    :param K: key passed to fn
+    :param M: input passed to fn, or a list of inputs for a fn that takes one
+    :return: best throughput over repeat runs, in MB/s of input
+    """
+    best = float("inf")
+    for i in range(repeat):
+        start = time.perf_counter()
+        fn(K, M)
+        best = min(best, time.perf_counter() - start)
+    size = sum(map(len, M)) if isinstance(M, list) else len(M)
+    return size / max(best, 1e-9) / 1e6
+
+"""
+    Generic collision search. Any keyed hash H(K, M) is turned into a
+    function on l_bytes-long strings f(x) = H(K, encode(x)). The default
+    encoding x || x makes f a random-looking function even for H1, which is
+    a permutation of any single varying block. A collision f(x) = f(x') with
+    x != x' gives colliding messages encode(x), encode(x').
+
+    birthday_collision stores every point in a dict and needs about
+    2^(l/2) evaluations and as much memory. dp_collision walks trails
+    x, f(x), f(f(x)), ... until a distinguished point, whose low dp_bits
+    bits are zero. It only remembers the trail ends, so memory is
+    2^(l/2 - dp_bits). Both give up and return (None, None) after
+    search_bound() evaluations of f by default, 64 times the expected
+    2^(l/2), which only happens when the encoding leaves f without
+    collisions, for example encode=lambda x: x with H1.
+
+    Trails can be walked by several processes, but only for a hash that is
+    the same function in every process. A lazily sampled E is not: each
+    forked worker would sample its own, so its trails would end in points
+    the caller's E never reaches. configure(k, l, seed) therefore offers a
+    seeded CompactBlockCipher, which gives the same answers in every
+    process, and dp_collision fans out over the cores exactly when E is
+    seeded, unless told otherwise. The rare answers that differ, where a
+    drawn value was already taken in one process, only produce false
+    collisions, which locate rejects. The collision is always located and
+    checked in the calling process.
+"""
+
+def double_block(x):
+    return x + x
+
+def search_bound():
+    """
+    :return: the default number of evaluations after which the collision
+    searches give up, 64 * 2^(l/2)
+    """
+    return 64 << (4 * l_bytes)
+
+def birthday_collision(H, K, encode=double_block, max_queries=None):
+    """
+    :param H: keyed hash H(K, M)
+    :param K: hash key
+    :param encode: maps an l_bytes string to a message
+    :param max_queries: give up after this many evaluations, search_bound()
+    if None
+    :return: (M1, M2) with M1 != M2 and H(K, M1) == H(K, M2), or (None, None)
+    """
+    if max_queries is None:
+        max_queries = search_bound()
+    seen = {}
+    queries = 0
+    while queries < max_queries:
+        x = random_string(l_bytes)
+        y = H(K, encode(x))
+        queries += 1
+        if y in seen and seen[y] != x:
+            return encode(seen[y]), encode(x)
+        seen[y] = x
+    return None, None
+
+def walk(H, K, encode, x, dp_mask, max_length):
+    """
+    :return: (distinguished point reached from x, number of steps), or
+    (None, steps) if no distinguished point was reached in max_length steps
+    """
+    for steps in range(1, max_length + 1):
+        x = H(K, encode(x))
+        if to_int(x) & dp_mask == 0:
+            return x, steps
+    return None, max_length
+
+_trail_task = None
+
+def _walk_trails(args):
+    """
+    :return: (list of (start, end, steps) for the trails that reached a
+    distinguished point, steps walked by all of them)
+    """
+    # Forked workers inherit the task, so H need not be picklable.
+    H, K, encode, dp_mask, max_length, count = args or _trail_task
+    trails = []
+    total = 0
+    for i in range(count):
+        start = random_string(l_bytes)
+        end, steps = walk(H, K, encode, start, dp_mask, max_length)
+        total += steps
+        if end is not None:
+            trails.append((start, end, steps))
+    return trails, total
+
+def locate(H, K, encode, a, la, b, lb):
+    """
+    Walks two trails that end in the same distinguished point in step and
+    returns the two distinct points that map to the same value.
+
+    :return: the pair, or None if the trails do not merge within la + lb
+    steps, which means the trail ends did not come from this H (a false
+    collision) or one trail lies on the other
+    """
+    f = lambda x: H(K, encode(x))
+    while la > lb:
+        a, la = f(a), la - 1
+    while lb > la:
+        b, lb = f(b), lb - 1
+    for step in range(la + lb):
+        if a == b:
+            return None
+        fa, fb = f(a), f(b)
+        if fa == fb:
+            return a, b
+        a, b = fa, fb
+    return None
+
+def dp_collision(H, K, encode=double_block, dp_bits=None, processes=None, batch=64, deterministic=None,
+                 max_steps=None):
+    """
+    :param H: keyed hash H(K, M)
+    :param K: hash key
+    :param encode: maps an l_bytes string to a message
+    :param dp_bits: low bits that must be zero at a distinguished point,
+    about a quarter of the output bits by default
+    :param processes: number of worker processes walking trails, defaults
+    to the core count, and is 1 unless H is deterministic or inside a
+    worker of another pool (e.g. run_trials)
+    :param batch: trails walked per task
+    :param deterministic: H is the same function in every process; by
+    default, whether E is seeded, which holds for H1 and H2 after
+    configure(k, l, seed)
+    :param max_steps: give up after this many evaluations, search_bound()
+    if None
+    :return: (M1, M2) with M1 != M2 and H(K, M1) == H(K, M2), or (None, None)
+    """
+    if dp_bits is None:
+        dp_bits = max(1, l_bytes * 8 // 4)
+    if deterministic is None:
+        deterministic = getattr(EE, "seeded", False)
+    if max_steps is None:
+        max_steps = search_bound()
+    processes = processes or os.cpu_count() or 1
+    if not deterministic or multiprocessing.current_process().daemon:
+        processes = 1
+    dp_mask = (1 << dp_bits) - 1
+    global _trail_task
+    task = (H, K, encode, dp_mask, 20 << dp_bits, batch)
+    ends = {}
+    walked = 0
+    pool = None
+    if processes > 1:
+        _trail_task = task
+        pool = multiprocessing.get_context("fork").Pool(processes)
+    try:
+        while walked < max_steps:
+            if pool:
+                results = pool.imap_unordered(_walk_trails, [None] * (4 * processes))
+            else:
+                results = [_walk_trails(task)]
+            for (trails, steps_walked) in results:
+                walked += steps_walked
+                for (start, end, steps) in trails:
+                    if end in ends and ends[end][0] != start:
+                        other, other_steps = ends[end]
+                        pair = locate(H, K, encode, start, steps, other, other_steps)
+                        if pair is not None:
+                            M1, M2 = encode(pair[0]), encode(pair[1])
+                            if M1 != M2 and H(K, M1) == H(K, M2):
+                                return M1, M2
+                    ends[end] = (start, steps)
+        return None, None
+    finally:
+        if pool:
+            pool.terminate()
+            pool.join()
+
+def collision_adversary(H, mode="birthday", **options):
+    """
+    :param H: keyed hash H(K, M)
+    :param mode: "birthday" or "dp"
+    :return: an adversary A(K) for CRSim that finds a collision generically
+    """
+    search = birthday_collision if mode == "birthday" else dp_collision
+    return lambda K: search(H, K, **options)
+
 """
 ========================================================================================
 Code below this line is used to test solution.
@@ -179,7 +545,46 @@ from playcrypt.games.game_lr import GameLR
 from playcrypt.simulator.lr_sim import LRSim
 from playcrypt.ideal.function_family import FunctionFamily
 
+def configure(k, l, seed=None):
+    """
+    Binds k_bytes, l_bytes and a fresh blockcipher E for Problem 2. Small
+    blocks, whose collision searches touch most points of E under every
+    game's key, get a CompactBlockCipher, and so does any size when a seed
+    is given, so that dp_collision can walk trails in several processes.
+
+    :param k: key length in bits
+    :param l: block length in bits
+    :param seed: seed of a CompactBlockCipher that answers the same in
+    every process, or None for a lazily sampled E
+    """
+    global k_bytes, l_bytes, EE, E, E_I
+    k_bytes = k//8
+    l_bytes = l//8
+    if seed is not None:
+        EE = cached(CompactBlockCipher(k_bytes, l_bytes, seed=seed))
+    elif l_bytes <= DENSE_MAX_BYTES:
+        EE = cached(CompactBlockCipher(k_bytes, l_bytes))
+    else:
+        EE = cached(BlockCipher(k_bytes, l_bytes))
+    E = EE.encrypt
+    E_I = EE.decrypt
+    instrument_globals(globals(), "E", "E_I")
+
+def sweep_cell(params, seed):
+    """
+    One cell of a sweep: the advantages of A1 against H1 and A2 against H2.
+
+    :param params: dict with k and l in bits
+    """
+    configure(params["k"], params["l"])
+    games = [clear_on_initialize(instrument_game(GameCR(H, k_bytes)), EE) for H in (H1, H2)]
+    return {"A1": run_trials(CRSim(games[0], A1), seed=seed),
+            "A2": run_trials(CRSim(games[1], A2), seed=seed)}
+
 if __name__ == '__main__':
+    # Coins come from a buffered PRG, which trial_runner reseeds per batch.
+    # Set RANDOM_SEED to repeat a run.
+    use(CounterPRG(SEED))
     print("--- Problem 1 ---")
     # Arbitrary choices of k, n.
     k = 128
@@ -188,10 +593,13 @@ if __name__ == '__main__':
     k_bytes = k//8
     n_bytes = n//8
 
-    FF = FunctionFamily(k_bytes, n_bytes, n_bytes)
+    # Set ORACLE_CACHE to memoize F and E, see oracle_cache.py.
+    FF = cached(FunctionFamily(k_bytes, n_bytes, n_bytes))
     F = FF.evaluate
+    # Records calls when INSTRUMENT_JSON is set, see instrument.py.
+    instrument_globals(globals(), "F")
 
-    g = GameLR(1, Enc, k_bytes)
+    g = clear_on_initialize(instrument_game(GameLR(1, Enc, k_bytes), "lr"), FF)
     s = LRSim(g, A)
 
     # test decryption
@@ -207,48 +615,57 @@ if __name__ == '__main__':
             break
     if worked:
         print ("Your decryption function appears correct.")
+
+    K = random_string(k_bytes)
+    M = random_string(8192 * n_bytes)
+    C = Enc_fast(K, M)
+    if Dec(K, C) != M or Dec_fast(K, C) != M or Dec_fast(K, Enc(K, M)) != M:
+        print ("The block engine disagrees with Enc/Dec.")
+    print ("Enc: %.2f MB/s, Enc_fast: %.2f MB/s" % (throughput(Enc, K, M), throughput(Enc_fast, K, M)))
+    print ("Dec: %.2f MB/s, Dec_fast: %.2f MB/s" % (throughput(Dec, K, C), throughput(Dec_fast, K, C)))
+
+    # Many short ciphertexts under one key.
+    Ms = [random_string(random.randrange(1, 64) * n_bytes) for i in range(256)]
+    Cs = [Enc_fast(K, Mi) for Mi in Ms]
+    if [Dec_fast(K, Ci) for Ci in Cs] != Ms:
+        print ("Dec_fast disagrees with Dec on short ciphertexts.")
+    print ("256 ciphertexts: Dec: %.2f MB/s, Dec_fast: %.2f MB/s"
+           % (throughput(lambda K, Cs: [Dec(K, Ci) for Ci in Cs], K, Cs),
+              throughput(lambda K, Cs: [Dec_fast(K, Ci) for Ci in Cs], K, Cs)))
     try:
-        print ("The advantage of your adversary A1 is approximately " + str(s.compute_advantage(20)))
+        print ("The advantage of your adversary A1 is approximately " + str(run_trials(s, 20)))
     except ValueError as e:
         print("Error computing advantage:", e)
 
     print()
     print("--- Problem 2 ---")
 
-    # Case 1: k = l = 128
-    k = 128
-    l = 128
-    k_bytes = k//8
-    l_bytes = l//8
-    EE = BlockCipher(k_bytes, l_bytes)
-    E = EE.encrypt
-    E_I = EE.decrypt
-
-    g1 = GameCR(H1, k_bytes)
-    s1 = CRSim(g1, A1)
-
-    g2 = GameCR(H2, k_bytes)
-    s2 = CRSim(g2, A2)
-
-    print("When k=128, l=128:")
-    print("The advantage of your adversary A1 is ~" + str(s1.compute_advantage()))
-    print("The advantage of your adversary A2 is ~" + str(s2.compute_advantage()))
-
-    # Case 2: k = 64 ; l = 16
-    k = 64
-    l = 16
-    k_bytes = k//8
-    l_bytes = l//8
-    EE = BlockCipher(k_bytes, l_bytes)
-    E = EE.encrypt
-    E_I = EE.decrypt
-
-    g1 = GameCR(H1, k_bytes)
-    s1 = CRSim(g1, A1)
-
-    g2 = GameCR(H2, k_bytes)
-    s2 = CRSim(g2, A2)
-
-    print("\nWhen k=64, l=16:")
-    print("The advantage of your adversary A1 is ~" + str(s1.compute_advantage()))
-    print("The advantage of your adversary A2 is ~" + str(s2.compute_advantage()))
+    configure(128, 128)
+    K = random_string(k_bytes)
+    M = random_string(4096 * l_bytes)
+    if H1(K, M) != H1_fast(K, M) or H2(K, M) != H2_fast(K, M):
+        print("The block engine disagrees with H1/H2.")
+    h1, h2 = H1Hasher(K), H2Hasher(K)
+    for i in range(0, len(M), 1000):
+        h1.update(M[i:i + 1000])
+        h2.update(M[i:i + 1000])
+    if h1.digest() != H1(K, M) or h2.digest() != H2(K, M):
+        print("The incremental hashers disagree with H1/H2.")
+    print("H1: %.2f MB/s, H1_fast: %.2f MB/s" % (throughput(H1, K, M), throughput(H1_fast, K, M)))
+    print("H2: %.2f MB/s, H2_fast: %.2f MB/s" % (throughput(H2, K, M), throughput(H2_fast, K, M)))
+
+    # Case 1: k = l = 128, case 2: k = 64, l = 16. Cells run in parallel and
+    # are cached in sweep_cache.json.
+    for (params, result) in sweep(sweep_cell, [{"k": 128, "l": 128}, {"k": 64, "l": 16}]):
+        print("\nWhen k=%(k)d, l=%(l)d:" % params)
+        print("The advantage of your adversary A1 is ~" + str(Estimate(*result["A1"])))
+        print("The advantage of your adversary A2 is ~" + str(Estimate(*result["A2"])))
+
+    configure(64, 16)
+    # Generic collision search, feasible at l=16.
+    for (name, H) in (("H1", H1_fast), ("H2", H2_fast)):
+        for mode in ("birthday", "dp"):
+            s3 = CRSim(GameCR(H, k_bytes), collision_adversary(H, mode))
+            print("The advantage of the generic %s adversary on %s is ~%s" % (mode, name, run_trials(s3, 20)))
+    dump()
+    report()
@@ -1,6 +1,8 @@
 import math
 import json
 import sys, os, itertools
+import random
+import multiprocessing
 
 from playcrypt.primitives import *
 from playcrypt.tools import *
@@ -8,6 +10,10 @@ from playcrypt.new_tools import *
 
 from playcrypt.games.game_pke_lr import GamePKELR
 from playcrypt.simulator.pke_lr_sim import PKELRSim
+from trial_runner import sequential_advantage
+from number_theory import has_small_factor, is_probable_prime, batch_inverse
+from randomness import random_Z_N_star, use, CounterPRG, SEED
+from instrument import instrument_globals, instrument_game, dump
 
 def ADD(a,b):
     return a+b
@@ -36,12 +42,123 @@ Consider the key-generation algorithm K and encryption algorithm E defined below
 
 
 def K():
-    (N, p, q, e, d) = K_rsa(k)
+    (N, p, q, e, d) = K_rsa_pool(k)
     pk = (N, e)
-    sk = (N, d)
+    sk = (N, d, p, q, d % (p - 1), d % (q - 1), MOD_INV(q, p))
     return (pk, sk)
 
 
+"""
+Prime pools. Generating fresh primes dominates K at production key sizes.
+A process that calls K in a loop, such as the correctness loop in main,
+therefore draws its primes from a queue that one worker process per core
+fills in the background, so keys come out about as many times faster as
+there are cores. K_rsa_pool(k) has the same interface as K_rsa(k).
+
+K_rsa_pool generates its primes on the spot when USE_PRIME_POOL is False,
+on a single core, where a worker would only compete with its consumer, and
+in daemonic processes. trial_runner's workers are daemonic and already keep
+every core busy, so main closes the pools with close_prime_pools before it
+starts them.
+
+Candidates come from the operating system's generator, as key material
+should, never from the random module's Mersenne Twister.
+"""
+
+USE_PRIME_POOL = True
+system_random = random.SystemRandom()
+
+def random_prime(bits, safe=False):
+    """
+    :param bits: bit length of the prime
+    :param safe: if True return p = 2q + 1 with q prime
+    :return: a random prime p with 2^(bits-1) <= p < 2^bits
+    """
+    while True:
+        p = system_random.getrandbits(bits) | (1 << (bits - 1)) | 1
+        if safe:
+            q = p // 2
+            if has_small_factor(q) or has_small_factor(p):
+                continue
+            if is_probable_prime(q, system_random) and is_probable_prime(p, system_random):
+                return p
+        elif is_probable_prime(p, system_random):
+            return p
+
+def _fill_pool(queue, bits, safe):
+    while True:
+        queue.put(random_prime(bits, safe))
+
+class PrimePool(object):
+    """
+    Primes of one size, generated in the background by worker processes.
+    """
+
+    def __init__(self, bits, safe=False, size=64, processes=None):
+        """
+        :param bits: bit length of the primes
+        :param safe: if True the pool holds safe primes p = 2q + 1
+        :param size: how many primes are kept ready
+        :param processes: number of worker processes filling the pool,
+        defaults to the core count
+        """
+        self.bits = bits
+        self.safe = safe
+        processes = processes or os.cpu_count() or 1
+        context = multiprocessing.get_context("fork")
+        self.queue = context.Queue(size)
+        self.workers = [context.Process(target=_fill_pool, args=(self.queue, bits, safe), daemon=True)
+                        for i in range(processes)]
+        for w in self.workers:
+            w.start()
+
+    def get(self):
+        return self.queue.get()
+
+    def close(self):
+        for w in self.workers:
+            w.terminate()
+        for w in self.workers:
+            w.join()
+
+prime_pools = {}
+
+def prime_pool(bits, safe=False):
+    """
+    :return: the shared PrimePool for primes of this size, started on first use
+    """
+    if (bits, safe) not in prime_pools:
+        prime_pools[(bits, safe)] = PrimePool(bits, safe)
+    return prime_pools[(bits, safe)]
+
+def close_prime_pools():
+    """
+    Stops the workers of every pool. Pools are started again on next use.
+    """
+    for pool in prime_pools.values():
+        pool.close()
+    prime_pools.clear()
+
+def K_rsa_pool(k, e=65537):
+    """
+    RSA generator drawing its primes from prime_pool.
+
+    :param k: bit length of the modulus N
+    :param e: public exponent
+    :return: (N, p, q, e, d) as returned by K_rsa
+    """
+    if not USE_PRIME_POOL or (os.cpu_count() or 1) < 2 or multiprocessing.current_process().daemon:
+        draw = lambda: random_prime(k // 2)
+    else:
+        draw = prime_pool(k // 2).get
+    while True:
+        p = draw()
+        q = draw()
+        phi = (p - 1) * (q - 1)
+        if p != q and math.gcd(e, phi) == 1:
+            return (p * q, p, q, e, MOD_INV(e, phi))
+
+
 def E(pk, M):
     """
     :param pk: The public key pk = (N, e) used to encrypt the message
@@ -66,10 +183,13 @@ decryption requirement, for messages that are in Z_N^* when the public key is (N
 """
 def D(sk, C):
     """
-    :param sk: The secret key used to decrypt the message
+    :param sk: The secret key used to decrypt the message, either (N, d) or
+    (N, d, p, q, dp, dq, qinv) as returned by K
     :param C: The ciphertext to be decrypted
     :return: return the decryption on the ciphertext C
     """
+    if len(sk) == 7:
+        return D_crt(sk, C)
     (V, W) = C;
     (N, d) = sk
     V_p = MOD_EXP(V,d,N);
@@ -77,6 +197,73 @@ def D(sk, C):
     M = MOD(W * W_p, N);
     return M;
 
+def D_crt(sk, C):
+    """
+    Decryption through the Chinese remainder theorem: V^d and its inverse
+    are computed modulo p and q, where the exponents and moduli are half the
+    size, and recombined with Garner's formula.
+
+    :param sk: (N, d, p, q, dp, dq, qinv) with dp = d mod (p-1),
+    dq = d mod (q-1) and qinv = q^-1 mod p
+    :param C: The ciphertext to be decrypted
+    :return: return the decryption on the ciphertext C
+    """
+    (V, W) = C
+    (N, d, p, q, dp, dq, qinv) = sk
+    U_p = MOD_INV(MOD_EXP(V % p, dp, p), p)     # U^-1 mod p, where U = V^d
+    U_q = MOD_INV(MOD_EXP(V % q, dq, q), q)     # U^-1 mod q
+    U_inv = U_q + q * MOD(qinv * (U_p - U_q), p)
+    return MOD(W * U_inv, N)
+
+"""
+Batch interface. E_batch and D_batch take any iterable of messages or
+ciphertexts under one key and yield the results in order, one chunk at a
+time. D_batch inverts a whole chunk with a single inversion
+(batch_inverse, Montgomery's trick). The exponent side is the CRT
+reduction of d that K already stores; Python's pow is already a windowed
+exponentiation in C, so a table built in Python for the fixed e or d
+would only be slower.
+"""
+
+def E_batch(pk, Ms):
+    """
+    :param pk: The public key pk = (N, e) used to encrypt the messages
+    :param Ms: iterable of plaintexts, each in Z_N^*
+    :return: generator of the encryptions of Ms, as E would return them
+    """
+    (N, e) = pk
+    for M in Ms:
+        if not in_Z_N_star(M, N):
+            raise ValueError("Message not in appropriate domain.")
+        U = random_Z_N_star(N)
+        yield (MOD_EXP(U, e, N), MOD(U * M, N))
+
+def D_batch(sk, Cs, chunk=256):
+    """
+    :param sk: The secret key, either (N, d) or (N, d, p, q, dp, dq, qinv)
+    :param Cs: iterable of ciphertexts
+    :param chunk: number of ciphertexts sharing one inversion
+    :return: generator of the decryptions of Cs, equal to calling D on each
+    """
+    Cs = iter(Cs)
+    N = sk[0]
+    while True:
+        block = list(itertools.islice(Cs, chunk))
+        if not block:
+            return
+        if len(sk) == 7:
+            (N, d, p, q, dp, dq, qinv) = sk
+            Us = []
+            for (V, W) in block:
+                U_p = MOD_EXP(V % p, dp, p)
+                U_q = MOD_EXP(V % q, dq, q)
+                Us.append(U_q + q * MOD(qinv * (U_p - U_q), p))
+        else:
+            (N, d) = sk
+            Us = [MOD_EXP(V, d, N) for (V, W) in block]
+        for ((V, W), U_inv) in zip(block, batch_inverse(Us, N)):
+            yield MOD(W * U_inv, N)
+
 """
 Specify in pseudocode an O(k^3)-time adversary A1 making one query to
 its LR oracle and achieving Adv_{AE}^{ind-cpa}(A1) = 1. Messages in the LR query
@@ -106,6 +293,11 @@ The following lines are used to test code.
 ==============================================================================================
 """
 def main():
+    # Coins come from a buffered PRG, which trial_runner reseeds per batch.
+    # Set RANDOM_SEED to repeat a run.
+    use(CounterPRG(SEED))
+    # Records calls when INSTRUMENT_JSON is set, see instrument.py.
+    instrument_globals(globals(), "MOD_EXP", "MOD_INV")
     def pk_gen():
             (pk,sk) = K()
             return pk
@@ -124,10 +316,13 @@ def main():
             break
     if worked:
         print ("Your decryption function appears correct.")
+    close_prime_pools()
 
-    gm = GamePKELR(1, 1, E, pk_gen)
+    gm = instrument_game(GamePKELR(1, 1, E, pk_gen), "lr")
     s = PKELRSim(gm, A1)
-    print ("The advantage of your adversary A1 is approx. " + str(s.compute_advantage()))
+    estimate, saved = sequential_advantage(s)
+    print ("The advantage of your adversary A1 is approx. " + str(estimate) + " (" + str(saved) + " trials saved)")
+    dump()
 
 if __name__ == "__main__":
     main()
@@ -1,4 +1,4 @@
-import sys, os, itertools, json
+import sys, os, itertools, json, time
 
 from playcrypt.tools import *
 from playcrypt.ideal.block_cipher import *
@@ -10,6 +10,11 @@ from playcrypt.simulator.lr_sim import LRSim
 from playcrypt.games.game_int_ctxt import GameINTCTXT
 from playcrypt.simulator.ctxt_sim import CTXTSim
 from playcrypt.ideal.function_family import *
+from trial_runner import run_trials, Estimate
+from randomness import random_string, use, CounterPRG, SEED
+from sweep import sweep
+from oracle_cache import cached, clear_on_initialize, report
+from instrument import instrument_globals, instrument_game, dump
 
 """
 Problem:
@@ -38,14 +43,19 @@ def Dec(K,C):
     C = split(C,2 * n_bytes)
     X1 = E_I(K,C[0])              #X1 = A1 || P1 in the pseudocode
     X2 = E_I(K,C[1])              #X2 = A2 || P2 in the pseudocode
-    X1 = split(X1,n_bytes)      #A1 is X1[0] ; P1 is X1[1]
-    X2 = split(X2,n_bytes)      #A2 is X2[0] ; P2 is X2[1]
+    return unpad(X1, X2)
 
-    if (X1[1] != "\x00" * n_bytes) or (X2[1] != "\xFF" * n_bytes) :
+def unpad(X1, X2):
+    """
+    Checks the redundancy of the deciphered blocks X1 = A1 || P1 and
+    X2 = A2 || P2 on packed integers: P1 must be 0^n and P2 must be 1^n.
+
+    :return: M = A1 xor A2, or None if the redundancy check fails
+    """
+    mask = (1 << 8 * n_bytes) - 1
+    if string_to_int(X1) & mask != 0 or string_to_int(X2) & mask != mask :
         return None
-    
-    M = xor_strings(X1[0],X2[0])
-    return M
+    return xor_strings(X1[:n_bytes],X2[:n_bytes])
     
 """
     Solutions
@@ -59,58 +69,114 @@ def A2(enc):
     :param enc: This is the oracle supplied by the game.
     return: a forged ciphertext
     """
-   
-    zero = "\x00" * n_bytes
-    C1 = random_string(n_bytes)
-    C2 = random_string(n_bytes)
-    
-    C11 = C1 + zero
-    C22 = zero + C2
-    
-    C_1 = enc(C11)
-    C_2 = enc(C22)
-    
-    C1 = split(C_1,n_bytes//2)
-    C2 = split(C_2,n_bytes//2)
-   
-       
-    return  C1[1] + C2[1]
-      
-   
+
+    M1 = random_string(n_bytes)
+    M2 = random_string(n_bytes)
+
+    C_1 = split(enc(M1),2 * n_bytes)     #E(K,A1||0^n) || E(K,A2||1^n) for M1
+    C_2 = split(enc(M2),2 * n_bytes)     #the same for M2
+
+    # Both halves are well formed, so the mix decrypts to A1 xor A2' and is new
+    # unless M1 and M2 used the same coins.
+    return C_1[0] + C_2[1]
 
 """
-==============================================================================================
-The following lines are used to test code.
-==============================================================================================
+    Batched forgery trials
 """
 
-if __name__ == '__main__':    
-    k = 128
-    n = 128
-    k_bytes = k//8
-    n_bytes = n//8
- 
-    EE = BlockCipher(k_bytes, 2*n_bytes)
-    E = EE.encrypt
-    E_I = EE.decrypt
+def Dec_batch(Ks, Cs):
+    """
+    Dec over many (key, ciphertext) pairs at once: every ciphertext is
+    split first, then all the blocks are deciphered, then all the
+    redundancy checks run. E_I keeps one lazy table per key, so blocks
+    under the same key share it.
+
+    :param Ks: list of keys
+    :param Cs: list of ciphertexts, None for a game without one
+    :return: the list of Dec(K, C), None where Dec rejects
+    """
+    blocks = [split(C, 2 * n_bytes) if C is not None and len(C) == 4 * n_bytes else None for C in Cs]
+    Xs = [(E_I(K, B[0]), E_I(K, B[1])) if B is not None else None for (K, B) in zip(Ks, blocks)]
+    return [unpad(*X) if X is not None else None for X in Xs]
 
-    g = GameINTCTXT(2, Enc, Dec, k_bytes)
-    s = CTXTSim(g, A2)
+def forgery_trials(adversary, games):
+    """
+    Runs independent INT-CTXT games of SE, at the current k_bytes, n_bytes
+    and E, against the adversary and counts its forgeries.
+
+    The games run in two passes. First every game's key is drawn and its
+    adversary is run against an enc oracle that calls Enc, keeping the
+    ciphertexts it issued. Then all the forgeries that are new go through
+    Dec_batch in one pass.
+
+    :param adversary: an adversary taking the enc oracle, such as A2
+    :param games: number of games to run
+    :return: (number of forgeries, forgeries per second)
+    """
+    start = time.time()
+    Ks = [random_string(k_bytes) for i in range(games)]
+    Cs = []
+    for K in Ks:
+        issued = set()
+        def enc(M, K=K, issued=issued):
+            C = Enc(K, M)
+            issued.add(C)
+            return C
+        C = adversary(enc)
+        Cs.append(C if C not in issued else None)
+    forgeries = sum(M is not None for M in Dec_batch(Ks, Cs))
+    return (forgeries, forgeries / max(time.time() - start, 1e-9))
 
-    print ("When k=128, n=128:")
-    print ("The advantage of your adversary A2 is ~" + str(s.compute_advantage()))
+"""
+    Parameter sweeps
+"""
 
-    k = 256
-    n = 128
+def configure(k, n):
+    """
+    Binds k_bytes, n_bytes and a fresh blockcipher E on 2n-bit blocks. E is
+    a BlockCipher: a CompactBlockCipher would save about 30% per game's key
+    here but answers about 8x slower, and every trial waits on E.
+
+    :param k: key length in bits
+    :param n: message length in bits
+    """
+    global k_bytes, n_bytes, EE, E, E_I
     k_bytes = k//8
     n_bytes = n//8
-
-    EE = BlockCipher(k_bytes, 2*n_bytes)
+    EE = cached(BlockCipher(k_bytes, 2*n_bytes))
     E = EE.encrypt
     E_I = EE.decrypt
+    instrument_globals(globals(), "E", "E_I")
 
-    g = GameINTCTXT(2, Enc, Dec, k_bytes)
-    s = CTXTSim(g, A2)
+def sweep_cell(params, seed):
+    """
+    One cell of a sweep: the advantage of A2.
+
+    :param params: dict with k and n in bits
+    """
+    configure(params["k"], params["n"])
+    s = CTXTSim(clear_on_initialize(instrument_game(GameINTCTXT(2, Enc, Dec, k_bytes), "enc"), EE), A2)
+    return {"advantage": run_trials(s, seed=seed)}
+
+"""
+==============================================================================================
+The following lines are used to test code.
+==============================================================================================
+"""
+
+if __name__ == '__main__':    
+    # Coins come from a buffered PRG, which trial_runner reseeds per batch.
+    # Set RANDOM_SEED to repeat a run.
+    use(CounterPRG(SEED))
 
-    print ("When k=256, n=128:")
-    print ("The advantage of your adversary A2 is ~" + str(s.compute_advantage()))
+    # Cells run in parallel and are cached in sweep_cache.json.
+    for (params, result) in sweep(sweep_cell, {"k": [128, 256], "n": [128, 256]}):
+        print ("When k=%(k)d, n=%(n)d:" % params)
+        print ("The advantage of your adversary A2 is ~" + str(Estimate(*result["advantage"])))
+        # Timed here rather than in the cell, so the rate is never replayed
+        # from the cache.
+        configure(params["k"], params["n"])
+        (forged, rate) = forgery_trials(A2, 1000)
+        print ("Batched trials: %d of 1000 games forged, %d forgeries/second" % (forged, rate))
+    dump()
+    report()
@@ -2,12 +2,18 @@
 Block Ciphers and Key Recovery Security Game
 """
 
-import json
-import sys, os, itertools
+import sys, os, itertools, time
+import multiprocessing
 
 from playcrypt.primitives import *
 from playcrypt.tools import *
 from playcrypt.ideal.block_cipher import *
+from trial_runner import run_trials, Estimate
+from sweep import sweep
+from instrument import instrument_globals, instrument_game, dump
+from compact_cipher import CompactBlockCipher
+from oracle_cache import cached, clear_on_initialize, report
+from randomness import random_string, use, CounterPRG, SEED
 
 """
 Problem: Let E be a blockcipher  E:{0, 1}^k x {0, 1}^n --> {0, 1}^n
@@ -74,15 +80,127 @@ def A3(fn):
     C2 = fn(M2)
     C3 = fn(M3)
     
-    for i in range(2**k):
-        K1 = int_to_string(i, k_bytes)
-        K2_1 = xor_strings(E_I(K1, C1), M1)
-        K2_2 = xor_strings(E_I(K1, C2), M2)
-        K2_3 = xor_strings(E_I(K1, C3), M3)
-        
-        if K2_1 == K2_2 and K2_2 == K2_3:
-            return K1 + K2_1
+    K, rate = search_K1([(M1, C1), (M2, C2), (M3, C3)])
+    return K
 
+"""
+    Exhaustive search over K1 shared by the adversaries above. The K1 space is
+    split into shards that a process pool scans in parallel, and the pool is
+    cancelled as soon as one shard reports a consistent key.
+
+    No precomputed table answers games faster. The oracle's answers
+    E(K1, M xor K2) depend on K2 as well, so a table looked up by them has
+    to span all 2^(k+n) keys K1 || K2, while the search costs 2^k
+    inversions of E per game.
+"""
+
+def consistent_key(K1, transcript):
+    """
+    :param K1: candidate first half of the key
+    :param transcript: list of (M_i, C_i) pairs returned by the oracle
+    :return: K1 + K2 if one K2 explains every pair under K1, None otherwise
+    """
+    M, C = transcript[0]
+    K2 = xor_strings(E_I(K1, C), M)
+    for (M, C) in transcript[1:]:
+        if xor_strings(E_I(K1, C), M) != K2:
+            return None
+    return K1 + K2
+
+def E_I_batch(K1s, C):
+    """
+    Batched inversion of one ciphertext block under many keys. Mapping E_I
+    over the keys keeps the per-key loop inside map() instead of Python
+    bytecode; a cipher with a vectorised inverse can be dropped in here.
+
+    :param K1s: list of candidate keys
+    :param C: ciphertext block
+    :return: list of E_I(K1, C) for every K1 in K1s
+    """
+    return list(map(E_I, K1s, itertools.repeat(C, len(K1s))))
+
+def search_block(transcript, K1s):
+    """
+    Filters a block of candidate keys one query pair at a time. K1 is
+    consistent exactly when E_I(K1, C_1) xor E_I(K1, C_i) = M_1 xor M_i for
+    every i, so K2 is only computed for the key that survives, and each pair
+    only inverts under the candidates still standing. A wrong K1 costs two
+    inversions however many queries the transcript holds.
+
+    :param transcript: list of (M_i, C_i) pairs returned by the oracle
+    :param K1s: list of candidate keys
+    :return: the first consistent key in the block, or None
+    """
+    M1, C1 = transcript[0]
+    X1s = E_I_batch(K1s, C1)
+    for (M, C) in transcript[1:]:
+        if not K1s:
+            return None
+        D = xor_strings(M1, M)
+        Xs = E_I_batch(K1s, C)
+        survivors = [j for j in range(len(K1s)) if xor_strings(X1s[j], Xs[j]) == D]
+        K1s = [K1s[j] for j in survivors]
+        X1s = [X1s[j] for j in survivors]
+    if not K1s:
+        return None
+    return K1s[0] + xor_strings(X1s[0], M1)
+
+def search_shard(transcript, start, stop, block_size=4096):
+    """
+    :param transcript: list of (M_i, C_i) pairs returned by the oracle
+    :param start: first candidate K1, as an integer
+    :param stop: end of the shard (exclusive)
+    :param block_size: number of candidates handed to search_block at once
+    :return: (the first consistent key in the shard or None, number of candidates tried)
+    """
+    for i in range(start, stop, block_size):
+        end = min(i + block_size, stop)
+        K = search_block(transcript, [int_to_string(j, k_bytes) for j in range(i, end)])
+        if K is not None:
+            return K, end - start
+    return None, stop - start
+
+def _search_shard(args):
+    return search_shard(*args)
+
+def search_K1(transcript, processes=None, shards_per_process=16):
+    """
+    Exhaustive search of the K1 space for a key consistent with the transcript.
+
+    Workers are forked after the oracle queries, so they inherit the lazily
+    sampled tables of the ideal cipher E for the real key. A key found by a
+    worker is checked again in this process before it is returned.
+
+    :param transcript: list of (M_i, C_i) pairs returned by the oracle
+    :param processes: number of worker processes, defaults to the core count,
+    and is 1 inside a worker of another pool (e.g. run_trials)
+    :param shards_per_process: how many shards each worker gets on average
+    :return: (K1 + K2, keys per second), the key is None if no K1 is consistent
+    """
+    processes = processes or os.cpu_count() or 1
+    if multiprocessing.current_process().daemon:
+        processes = 1
+    space = 2**k
+    start_time = time.time()
+    if processes == 1:
+        K, tried = search_shard(transcript, 0, space)
+        return K, tried / max(time.time() - start_time, 1e-9)
+
+    size = max(1, space // (processes * shards_per_process))
+    shards = [(transcript, i, min(i + size, space)) for i in range(0, space, size)]
+    tried = 0
+    K = None
+    pool = multiprocessing.get_context("fork").Pool(processes)
+    try:
+        for (result, count) in pool.imap_unordered(_search_shard, shards):
+            tried += count
+            if result is not None and consistent_key(result[:k_bytes], transcript) == result:
+                K = result
+                break
+    finally:
+        pool.terminate()
+        pool.join()
+    return K, tried / max(time.time() - start_time, 1e-9)
     
 """
 ==============================================================================================
@@ -93,29 +211,58 @@ The following lines are used to test the adversary code
 from playcrypt.games.game_kr import GameKR
 from playcrypt.simulator.kr_sim import KRSim
 
-if __name__ == '__main__':
+def configure(k_bits, n_bits, cipher=BlockCipher):
+    """
+    Binds k, n, k_bytes, n_bytes and a fresh blockcipher E with its inverse E_I.
 
-    # Arbitrary choices of k, n.
-    k = 128
-    n = 64
-    # Block & key size in bytes.
+    :param k_bits: key length of E in bits
+    :param n_bits: block length of E in bits
+    :param cipher: BlockCipher, or CompactBlockCipher for exhaustive runs
+    """
+    global k, n, k_bytes, n_bytes, EE, E, E_I
+    k = k_bits
+    n = n_bits
     k_bytes = k//8
     n_bytes = n//8
-    EE = BlockCipher(k_bytes, n_bytes)
+    EE = cached(cipher(k_bytes, n_bytes))
     E = EE.encrypt
     E_I = EE.decrypt
-    g1 = GameKR(1, F, k_bytes+n_bytes, n_bytes)
-    s1 = KRSim(g1, A1)
-    print("The advantage of your adversary A1 is approximately " + str(s1.compute_advantage(20)))
+    instrument_globals(globals(), "E", "E_I", "F")
 
-    # Smaller choices of k, n.
-    k = 8
-    n = 64
-    k_bytes = k//8
-    n_bytes = n//8
-    EE = BlockCipher(k_bytes, n_bytes)
-    E = EE.encrypt
-    E_I = EE.decrypt
-    g3 = GameKR(3, F, k_bytes+n_bytes, n_bytes)
-    s3 = KRSim(g3, A3)
-    print("The advantage of your adversary A3 is approximately " + str(s3.compute_advantage(20)))
+adversaries = {"A1": (1, A1), "A3": (3, A3)}
+ciphers = {"ideal": BlockCipher, "compact": CompactBlockCipher}
+
+def sweep_cell(params, seed):
+    """
+    One cell of a sweep: the advantage of one adversary at one (k, n).
+
+    :param params: dict with k and n in bits, the adversary's name and the
+    cipher's name
+    """
+    configure(params["k"], params["n"], ciphers[params["cipher"]])
+    (q, A) = adversaries[params["adversary"]]
+    s = KRSim(clear_on_initialize(instrument_game(GameKR(q, F, k_bytes+n_bytes, n_bytes), "fn"), EE), A)
+    return run_trials(s, 20, seed=seed)
+
+if __name__ == '__main__':
+    # Coins come from a buffered PRG, which trial_runner reseeds per batch.
+    # Set RANDOM_SEED to repeat a run.
+    use(CounterPRG(SEED))
+
+    # Arbitrary choices of k, n for A1 and smaller ones for A3. The search
+    # touches every K1, so E is a CompactBlockCipher there. Cells run in
+    # parallel and are cached in sweep_cache.json.
+    cells = [{"k": 128, "n": 64, "adversary": "A1", "cipher": "ideal"},
+             {"k": 8, "n": 64, "adversary": "A3", "cipher": "compact"}]
+    for (params, result) in sweep(sweep_cell, cells):
+        print("The advantage of your adversary %s at k=%d, n=%d is approximately %s"
+              % (params["adversary"], params["k"], params["n"], Estimate(*result)))
+
+    # Search rate of the K1 search on a fresh key.
+    configure(8, 64, CompactBlockCipher)
+    K = random_string(k_bytes + n_bytes)
+    M = [n_bytes * '\x00', n_bytes * '\x11', n_bytes * '\x01']
+    K_found, rate = search_K1([(Mi, F(K, Mi)) for Mi in M])
+    print("K1 search recovered the key: " + str(K_found == K) + ", " + str(int(rate)) + " keys/second")
+    dump()
+    report()
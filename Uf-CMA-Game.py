@@ -1,12 +1,18 @@
 import math
 import json
 import sys, os, itertools
+import random
+from collections import OrderedDict
 
 from playcrypt.primitives import *
 from playcrypt.tools import *
 from playcrypt.new_tools import *
 from playcrypt.games.game_ufcma import GameUFCMA
 from playcrypt.simulator.ufcma_sim import UFCMASim
+from trial_runner import sequential_advantage
+from number_theory import has_small_factor, is_probable_prime, batch_inverse
+from randomness import random_Z_N_star, use, CounterPRG, SEED
+from instrument import instrument_globals, instrument_game, dump
 
 def ADD(a,b):
     return a+b
@@ -26,6 +32,148 @@ def MOD_INV(a,N):
 def MOD_EXP(a,n,N):
     return exp(a,n,N)
 
+"""
+Fixed-base exponentiation. For a base raised to many exponents modulo the
+same modulus, table[i][j] = base^(j * 2^(w*i)) is computed once, and then
+base^x is one multiplication per nonzero w-bit digit of x, with no
+squarings. At 2048 bits and w = 4 that is at most 512 multiplications
+against roughly 2500 for MOD_EXP. Tables are kept per (base, modulus) in an
+LRU cache. A table is only built the second time a base is seen, so a
+public key used once costs no more than MOD_EXP.
+"""
+
+FIXED_BASE_WINDOW = 4
+FIXED_BASE_CACHE_SIZE = 8
+fixed_base_tables = OrderedDict()
+
+def fixed_base_table(base, N, window=FIXED_BASE_WINDOW):
+    """
+    :param base: the fixed base
+    :param N: modulus
+    :param window: number of exponent bits handled per table row
+    :return: the rows table[i][j] = base^(j * 2^(window*i)) mod N covering
+    exponents below 2^(bit length of N)
+    """
+    table = []
+    b = base % N
+    for i in range(0, N.bit_length(), window):
+        row = [1, b]
+        for j in range(2, 1 << window):
+            row.append(MOD(row[-1] * b, N))
+        table.append(row)
+        b = MOD(row[-1] * b, N)
+    return table
+
+def FIXED_EXP(a, n, N):
+    """
+    MOD_EXP(a, n, N) through the fixed-base table of (a, N).
+    """
+    key = (a, N)
+    entry = fixed_base_tables.get(key)
+    if entry is None:
+        fixed_base_tables[key] = entry = [None]
+        if len(fixed_base_tables) > FIXED_BASE_CACHE_SIZE:
+            fixed_base_tables.popitem(last=False)
+        return MOD_EXP(a, n, N)
+    fixed_base_tables.move_to_end(key)
+    if n < 0 or n.bit_length() > N.bit_length():
+        return MOD_EXP(a, n, N)
+    if entry[0] is None:
+        entry[0] = fixed_base_table(a, N)
+    mask = (1 << FIXED_BASE_WINDOW) - 1
+    result = 1
+    for row in entry[0]:
+        if n == 0:
+            break
+        digit = n & mask
+        if digit:
+            result = MOD(result * row[digit], N)
+        n >>= FIXED_BASE_WINDOW
+    return result % N
+
+"""
+Group parameters. group_params(bits, seed) returns a safe prime p = 2q + 1
+of the given size and a generator g of Z_p^*, derived deterministically
+from the seed and cached in a JSON file, so later runs load them instead
+of searching again. Because the factorization of p - 1 is 2 * q, g is a
+generator exactly when g^2 != 1 and g^q != 1 mod p, which takes two
+exponentiations per candidate.
+"""
+
+GROUP_STORE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "group_params.json")
+
+def safe_prime(bits, rng):
+    """
+    :return: (p, q) with p = 2q + 1 a bits-bit prime and q prime
+    """
+    if bits < 3:
+        raise ValueError("There is no safe prime of fewer than 3 bits.")
+    while True:
+        q = rng.getrandbits(bits - 1) | (1 << (bits - 2)) | 1
+        p = 2 * q + 1
+        if has_small_factor(q) or has_small_factor(p):
+            continue
+        if is_probable_prime(q, rng) and is_probable_prime(p, rng):
+            return (p, q)
+
+def safe_prime_generator(p, q):
+    """
+    :return: the smallest generator of Z_p^* for the safe prime p = 2q + 1
+    """
+    g = 2
+    while MOD_EXP(g, 2, p) == 1 or MOD_EXP(g, q, p) == 1:
+        g += 1
+    return g
+
+def load_groups(path=GROUP_STORE):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+def group_params(bits, seed=0, path=GROUP_STORE):
+    """
+    :param bits: bit length j of p
+    :param seed: selects the group; the same (bits, seed) always gives the
+    same parameters
+    :param path: JSON file the parameters are cached in
+    :return: (p, q, g)
+    """
+    key = "%d:%s" % (bits, seed)
+    groups = load_groups(path)
+    if key in groups:
+        entry = groups[key]
+        return (int(entry["p"]), int(entry["q"]), entry["g"])
+    (p, q) = safe_prime(bits, random.Random(key))
+    g = safe_prime_generator(p, q)
+    groups = load_groups(path)
+    groups[key] = {"p": str(p), "q": str(q), "g": g}
+    with open(path + ".tmp", "w") as f:
+        json.dump(groups, f, indent=1)
+    os.replace(path + ".tmp", path)
+    return (p, q, g)
+
+"""
+Key material. Key is an int, so it can be passed wherever K1 and kgen keys
+were used before, and it also carries its inverse modulo p - 1, computed
+once at key generation instead of on every D1 call.
+"""
+
+class Key(int):
+    def __new__(cls, value, modulus):
+        """
+        :param value: the key, in Z_modulus^*
+        :param modulus: the modulus the key is inverted under (p - 1)
+        """
+        key = int.__new__(cls, value)
+        key.modulus = modulus
+        key.inverse = MOD_INV(value, modulus)
+        return key
+
+    def __reduce__(self):
+        # int's own reduction would call Key(value) without the modulus.
+        return (Key, (int(self), self.modulus))
+
 """
 Problem 1:
 Let p>=3 be a prime and g \in Z_p^* be a generator of Z_p^*.
@@ -34,8 +182,8 @@ The message M must be in Z_p^*, meaning the message space is Z_p^I. Let k be the
 """
 
 def K1():
-    x = random_Z_N_star(p - 1)
-    X = MOD_EXP(g, x, p)
+    x = Key(random_Z_N_star(p - 1), p - 1)
+    X = FIXED_EXP(g, x, p)
     sk = x
     pk = X
     return (pk, sk)
@@ -45,8 +193,8 @@ def E1(pk,M):
     if not in_Z_N_star(M, p):           # if M not in Z_p^I then return fail
         raise ValueError("Message not in appropriate domain")
     y = random_Z_N_star(p - 1)          # Assign to y a random element of Z_{p-1}^*
-    Y = MOD_EXP(g, y, p)                # Y <- g^y mod p
-    Z = MOD_EXP(X, y, p)                # Z <- X^y mod p = (g^x)^y mod p
+    Y = FIXED_EXP(g, y, p)              # Y <- g^y mod p
+    Z = FIXED_EXP(X, y, p)              # Z <- X^y mod p = (g^x)^y mod p
     W = MOD(Y * M, p)                   # W <- (Y * M) mod p
     return (Z, W)
 
@@ -66,7 +214,10 @@ def D1(sk, C):
     :return: return the decryption on the ciphertext C
     """
     Z, W = C
-    sk_inverse = MOD_INV(sk, p-1)    
+    if isinstance(sk, Key) and sk.modulus == p-1:
+        sk_inverse = sk.inverse
+    else:
+        sk_inverse = MOD_INV(sk, p-1)
     Y = MOD_EXP(Z, sk_inverse, p)
     Y_inverse = MOD_INV(Y, p)
     M = (W * Y_inverse) % p
@@ -93,9 +244,26 @@ def T(K, M):
         raise ValueError("Key not in appropriate domain.")
     w = MOD(MULT(M,K), p-1)
     x = MOD_INV(w, p-1)
-    Y = MOD_EXP(g,x,p)
+    Y = FIXED_EXP(g,x,p)
     return Y
 
+def T_batch(K, Ms):
+    """
+    T(K, M) for every M in Ms, with the products M*K inverted together by
+    batch_inverse and the powers of g taken from the fixed-base table.
+
+    :param K: The key that is in Z_{p-1}^*
+    :param Ms: list of plaintexts, each in Z_{p-1}^*
+    :return: list of the outputs T(K, M)
+    """
+    if not in_Z_N_star(K,p-1):
+        raise ValueError("Key not in appropriate domain.")
+    for M in Ms:
+        if not in_Z_N_star(M,p-1):
+            raise ValueError("Message not in appropriate domain.")
+    xs = batch_inverse([MOD(MULT(M,K), p-1) for M in Ms], p-1)
+    return [FIXED_EXP(g,x,p) for x in xs]
+
 """
 The message M must be in Z_{p-1}^*, meaning only elements of Z_{p-1}^* are allowed as
 messages. We let k be the bit-length of q.
@@ -128,14 +296,20 @@ def V(K, M, t):
         return 0
 
 def kgen():
-    return random_Z_N_star(p-1)
+    return Key(random_Z_N_star(p-1), p-1)
 
 def main():
+    # Coins come from a buffered PRG, which trial_runner reseeds per batch.
+    # Set RANDOM_SEED to repeat a run.
+    use(CounterPRG(SEED))
+    # Records calls when INSTRUMENT_JSON is set, see instrument.py. K1, E1
+    # and T exponentiate through FIXED_EXP, which falls back to MOD_EXP the
+    # first time it sees a base, so those calls count under both names.
+    instrument_globals(globals(), "MOD_EXP", "MOD_INV", "FIXED_EXP")
     print("When j=16:")
     j = 16
-    global p,g
-    p = prime_between(2**(j-1),2**j)
-    g = find_generator_Z_N_star(p)
+    global p,q,g
+    (p, q, g) = group_params(j)
 
     worked = True
     for loop in range(100):
@@ -177,10 +351,12 @@ def main():
     q = int(s1)
     g = 5
 
-    gm = GameUFCMA(1, T, V, None, kgen)
+    gm = instrument_game(GameUFCMA(1, T, V, None, kgen), "tag")
     s = UFCMASim(gm, A)
 
-    print ("The advantage of your adversary is ~" + str(s.compute_advantage()))
+    estimate, saved = sequential_advantage(s)
+    print ("The advantage of your adversary is ~" + str(estimate) + " (" + str(saved) + " trials saved)")
+    dump()
 
 
 if __name__ == "__main__":
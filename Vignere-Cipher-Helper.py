@@ -1,90 +1,326 @@
 #This program was used to help me with determining the length of the key that was used to encrypt the ciphertext given. 
-#The program does not determine the key itself. 
+#It can also recover the key itself by chi-squared scoring of every column against english letter frequencies.
 
-#importing a library to help me separate the ciphertext into n-character chunks. This library does not directly solve the problem.
-from textwrap import wrap
+#importing mul so the chi-squared dot products run inside sum(map(...)) instead of a python loop.
+from operator import mul
+
+#importing mmap so ciphertext files larger than memory can be analysed without reading them in.
+import os, sys, mmap
+
+#importing numpy, if it is installed, so recover_keys can count and score a whole batch of ciphertexts at once.
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 ciphertext = 'NBLRFMGYMYNUAGJKGRWPHIGISHTXHHLBQQVHCGZXVBHONVRVAFJYGUIGXTIEPMWTILFRKBJHSZRAMAWMVETRGMYADJENBAHEQJZWNBXAWNUCGDTVTAGHQQVFHCBQATSRZNFQENHUGLVZGFINGMVTAGRUKXFGMHFPBYWMVPXHWHUAWNHWCOEJTHGOFRFWGTASNQLHZFHNWQHSOFFHKNWWNLWWAFJYFWZHSUYAFZRUHCBQAMFBXNULLYVYQHDXQCJZHVMFBXERJNXHUQRXMNCHBIAMWCHTHVVWMJGLWGNGUXHGMTCFGRAXHILRFWFRSLPHIGIHLNGMLFTYTXIKIDLVYIMJWHSRZFFHCBQXKTAIGHNKJSYKSZXXGCBQIGIOMFRKBFHCBQIGIGNEHVZYVYAFGUJFMRFCKNHSGKMWJDUEWUXSHCFRVMMSZERVMQWHRVWYYVYSLOAYOANLVLYQSOHZVWWGRDVWBSEAREYNFMGKIGIHBRGIFFUYGKIMHOHOHKTZGYQEGMMCMRZPHJLJYRQMAIFAHZTGZYNQLBSGYPXZXXMMGHULBSMHSXHWHUAGMGHCOEDOXYVYHVMHKGYPXZXSSNJRZDXHICUMOJBNPBJXWHBEHIMXHIBXZVWWNVFIESONVRVTQWHSUILYFOPWCKJCOELVMJZFRFBNFZJERXXWHSNQLHZFXNWILTOMGRXKTAIGHWNWCPRUIEQGUSHBRFAYELKTSQCGLHXSGWNUMWJSJYBIUTINCUQOFQSNQLKNUBGOGLTAUABKHRDUALMLMOPREMXSFYFSWGIWHTWWTROLXHBWJAUAGNHWDLBGCVYGUAGAXWJCPHAMMONCUWMJQNGKMIWWPNFGTSRMRFCKNHSBIBAJWLPXAMTAYEVBANGBNVOXSSLNWMWUCMVWQOJWHARDTYWIAWPTYVUFEMXSQLHFQTQHIGKMWNUCGDTXHCHBPGPJHIBFIKJOVBXBMMSMRLUITFNNQBIWWHPLXEJGCAGMXIWNVVWNWCVYLOTYWIAWWNUVIYGKBAWFYLJXWHCRVQGHZOQLVZYVYELOAYHICUQOFQSJHPTASUYZIRXFYFSMVYSXGKMYZBXNPMGYOFELOAYCZCHWIQSNBHVZFUYVQXKNJUGHKHRAOALKTYWIAVZXLOLQOMLXCZGKMFJRCHPWKYSWUQWETUSJKMMMSLVWQLNBMGDVMRSMFDOXXHYKWAHWCFQIILMWIAHLEJHNRUAVNHCMHVLMOPRWPXWWAUWBHHCGZXVB'
 
-#function used to list the divisors of a given number
-def getDivisors(n):
-    l = []
-    for i in range(2,n):
-        if n % i == 0:
-            l.append(i)
-    return l
-
-#function used to determine the offset of ever 3-character pattern in the ciphertext
-def tupleOffset(l):
-    i = 0
-    offset = []
-    div = []
-    while i < len(l): #loop through whole ciphertext
-        tuple1 = l[i:i+3] #take a 3-character tuple
-        tupleLenth = len(tuple1)
-        if tupleLenth == 3: #if not 3, then we've reached the end of ciphertext
-            for j in range(i+1, len(l)): #trying to find same pattern of 3-character tuple
-                tuple2 = l[j:j+3]
-                if tuple1 == tuple2:
-                    diff = j - i #get their offset
-                    offset.append(int(diff)) #write it onto the list
-                    divi = getDivisors(diff)
-                    div.append(getDivisors(diff))
-                    #print('pattern: ' + str(tuple2) + '\n' + 'offset: ' + str(diff) + '\n' + 'divisors: ' + str(divi) +'\n')
+#function used to add every repeated n-character pattern of text to the position table `seen` in one pass.
+#each n-gram is hashed into a dict holding the position it was last seen at, so a repeat is found
+#in O(1) instead of rescanning the rest of the ciphertext. offsets maps each distance to how often it occurred.
+#with allPairs=True every earlier occurrence is kept (the old O(n^2) behaviour, but only among equal n-grams).
+#start is the position of text[0] in the whole ciphertext, so the tables can be fed one chunk at a time
+def updateOffsets(text, seen, offsets, ngram=3, allPairs=False, start=0):
+    for i in range(len(text) - ngram + 1):
+        gram = text[i:i+ngram]
+        position = start + i
+        if gram in seen:
+            if allPairs:
+                for j in seen[gram]:
+                    offsets[position - j] = offsets.get(position - j, 0) + 1
+                seen[gram].append(position)
+            else:
+                diff = position - seen[gram]
+                offsets[diff] = offsets.get(diff, 0) + 1
+                seen[gram] = position
+        else:
+            seen[gram] = [position] if allPairs else position
+
+#function used to build the offset table of a whole ciphertext
+def ngramOffsets(text, ngram=3, allPairs=False):
+    offsets = {}
+    updateOffsets(text, {}, offsets, ngram, allPairs)
+    return offsets
+
+#function used to count how many offsets each divisor 1 < x <= maxDivisor divides, using a sieve over
+#the multiples of x instead of trial division of every offset. like before, an offset is not counted
+#as its own divisor. the index represents the divisor, the value represents the frequency
+def divisorFrequency(offsets, maxDivisor=15):
+    largest = max(offsets) if offsets else 0
+    if maxDivisor is None:
+        maxDivisor = largest
+    freqList = [0] * (maxDivisor + 1)
+    for x in range(2, maxDivisor + 1):
+        count = 0
+        for multiple in range(2 * x, largest + 1, x):
+            count = count + offsets.get(multiple, 0)
+        freqList[x] = count
+    return freqList
+
+#function used to run the whole Kasiski examination in time linear in the length of the text.
+#returns the offset table from ngramOffsets and the divisor frequencies from divisorFrequency.
+#maxDivisor=None counts every divisor instead of only the short key lengths
+def kasiski_index(text, ngram=3, maxDivisor=15, allPairs=False):
+    offsets = ngramOffsets(text, ngram, allPairs)
+    return offsets, divisorFrequency(offsets, maxDivisor)
+
+#uppercase letters as byte values, used to count letters in a bytes column
+LETTERS = [ord('A') + i for i in range(26)]
+
+#function used to count the letters in each column of the ciphertext when it is written in rows of keyLength.
+#every column is read with a single strided slice of the ciphertext bytes, so no chunks are built.
+#returns a 26 x keyLength matrix: row i is the letter chr(65+i), column k is position k of the key
+def columnCounts(text, keyLength):
+    if isinstance(text, str):
+        text = text.encode('ascii')
+    columns = [text[k::keyLength] for k in range(keyLength)]
+    return [[column.count(letter) for column in columns] for letter in LETTERS]
+
+#function used to add the letters of a piece of ciphertext that starts at `position` to an existing count matrix.
+#the first byte of the piece belongs to column position % keyLength, so each strided slice starts there
+def updateColumnCounts(counts, text, position):
+    keyLength = len(counts[0])
+    for k in range(keyLength):
+        column = text[(k - position) % keyLength::keyLength]
+        for i in range(26):
+            counts[i][k] = counts[i][k] + column.count(LETTERS[i])
+
+#function used to build the count matrix for many candidate key lengths at once.
+#the text is encoded only once and shared by every length
+def columnCountsBatch(text, keyLengths):
+    if isinstance(text, str):
+        text = text.encode('ascii')
+    return {keyLength: columnCounts(text, keyLength) for keyLength in keyLengths}
+
+#function used to compute the index of coincidence of every column of a count matrix
+def indexOfCoincidence(counts):
+    ioc = []
+    for column in zip(*counts):
+        total = sum(column)
+        if total < 2:
+            ioc.append(0.0)
+        else:
+            ioc.append((sum(map(mul, column, column)) - total) / (total * (total - 1)))
+    return ioc
+
+#function used to score every candidate key length by the average index of coincidence of its columns.
+#english text scores about 0.066 and random letters about 0.038, so the right length stands out
+def keyLengthScores(text, keyLengths=range(2, 16)):
+    scores = {}
+    for keyLength, counts in columnCountsBatch(text, keyLengths).items():
+        ioc = indexOfCoincidence(counts)
+        scores[keyLength] = sum(ioc) / len(ioc)
+    return scores
+
+#relative frequencies of the letters A-Z in english text
+ENGLISH = [0.08167, 0.01492, 0.02782, 0.04253, 0.12702, 0.02228, 0.02015, 0.06094, 0.06966, 0.00153, 0.00772, 0.04025, 0.02406,
+           0.06749, 0.07507, 0.01929, 0.00095, 0.05987, 0.06327, 0.09056, 0.02758, 0.00978, 0.02360, 0.00150, 0.01974, 0.00074]
+
+#the chi-squared statistic of a column shifted back by s is sum_i c[i+s]^2 / (N * ENGLISH[i]) - N, so scoring all 26 shifts
+#is one product of the squared counts with this circulant matrix: SHIFT_WEIGHTS[s][j] = 1 / ENGLISH[j - s]
+SHIFT_WEIGHTS = [[1 / ENGLISH[(j - s) % 26] for j in range(26)] for s in range(26)]
+
+#tables used by bytes.translate to shift a column of ciphertext back by each of the 26 possible key letters
+UNSHIFT = [bytes.maketrans(bytes(LETTERS), bytes(LETTERS[-s:] + LETTERS[:-s])) for s in range(26)]
+
+#function used to compute the chi-squared statistic of all 26 shifts of every column of a count matrix.
+#returns a keyLength x 26 matrix: entry [k][s] scores the key letter chr(65+s) at position k of the key
+def chiSquaredShifts(counts):
+    chi = []
+    for column in zip(*counts):
+        squares = list(map(mul, column, column))
+        total = sum(column) or 1
+        chi.append([sum(map(mul, squares, weights)) / total - total for weights in SHIFT_WEIGHTS])
+    return chi
+
+#function used to decrypt a vigenere ciphertext with a known key, one translated column at a time
+def decrypt(text, key):
+    if isinstance(text, str):
+        text = text.encode('ascii')
+    keyLength = len(key)
+    plain = bytearray(len(text))
+    for k in range(keyLength):
+        plain[k::keyLength] = text[k::keyLength].translate(UNSHIFT[ord(key[k]) - 65])
+    return plain.decode('ascii')
+
+#function used to rank candidate keys from the count matrices of several key lengths (as built by columnCountsBatch).
+#the key lengths are ranked by index of coincidence and the best `top` of them get a key from the
+#lowest chi-squared shift of each column. multiples of a length already picked are skipped, and keys that
+#only repeat a shorter key are folded into it.
+#returns (key, score) pairs sorted by average chi-squared per column, best first
+def rankKeys(counts, top=3):
+    scores = {}
+    for keyLength in counts:
+        ioc = indexOfCoincidence(counts[keyLength])
+        scores[keyLength] = sum(ioc) / len(ioc)
+    chosen = []
+    for keyLength in sorted(counts, key=lambda x: -scores[x]):
+        if len(chosen) == top:
+            break
+        if not any(keyLength % shorter == 0 for shorter in chosen):
+            chosen.append(keyLength)
+    ranked = {}
+    for keyLength in chosen:
+        chi = chiSquaredShifts(counts[keyLength])
+        shifts = [row.index(min(row)) for row in chi]
+        key = ''.join(chr(65 + shift) for shift in shifts)
+        for period in range(1, keyLength):
+            if keyLength % period == 0 and key == key[:period] * (keyLength // period):
+                key = key[:period]
+                break
+        score = sum(min(row) for row in chi) / keyLength
+        if key not in ranked or score < ranked[key]:
+            ranked[key] = score
+    return sorted(ranked.items(), key=lambda item: item[1])
+
+#function used to recover the key of a vigenere ciphertext without reading the histograms by hand.
+#returns the candidate keys ranked by rankKeys, and the plaintext under the best key
+def recover_key(text, keyLengths=range(2, 16), top=3):
+    if isinstance(text, str):
+        text = text.encode('ascii')
+    keys = rankKeys(columnCountsBatch(text, keyLengths), top)
+    return keys, decrypt(text, keys[0][0])
+
+#function used to run recover_key over many ciphertexts, returning one (keys, plaintext) pair per ciphertext.
+#with numpy the letters of all the texts are counted for each key length by a single bincount, and the index of
+#coincidence and the chi-squared scores of all 26 shifts are array operations over the whole batch, so only the
+#choice of key lengths and the decryption are left per text. without numpy it calls recover_key on each text
+def recover_keys(texts, keyLengths=range(2, 16), top=3):
+    if numpy is None:
+        return [recover_key(text, keyLengths, top) for text in texts]
+    texts = [text.encode('ascii') if isinstance(text, str) else bytes(text) for text in texts]
+    if not texts:
+        return []
+    keyLengths = list(keyLengths)
+    sizes = numpy.array([len(text) for text in texts])
+    letters = numpy.frombuffer(b''.join(texts), dtype=numpy.uint8).astype(numpy.int64) - 65
+    owner = numpy.repeat(numpy.arange(len(texts)), sizes)
+    position = numpy.arange(len(letters)) - numpy.repeat(numpy.cumsum(sizes) - sizes, sizes)
+
+    #counts[keyLength][t] is the transposed count matrix of text t: row k is column k of the ciphertext
+    counts = {}
+    scores = numpy.empty((len(texts), len(keyLengths)))
+    for j, keyLength in enumerate(keyLengths):
+        index = (owner * keyLength + position % keyLength) * 26 + letters
+        c = numpy.bincount(index, minlength=len(texts) * keyLength * 26).reshape(len(texts), keyLength, 26)
+        total = c.sum(axis=2)
+        ioc = ((c * c).sum(axis=2) - total) / numpy.maximum(total * (total - 1), 1)
+        scores[:, j] = numpy.where(total < 2, 0.0, ioc).mean(axis=1)
+        counts[keyLength] = c
+
+    #the key lengths each text keeps, as in rankKeys, grouped by length so each group is scored at once
+    chosen = [[] for text in texts]
+    groups = {}
+    for t, order in enumerate(numpy.argsort(-scores, axis=1, kind='stable')):
+        for j in order:
+            keyLength = keyLengths[j]
+            if len(chosen[t]) == top:
+                break
+            if not any(keyLength % shorter == 0 for shorter in chosen[t]):
+                chosen[t].append(keyLength)
+                groups.setdefault(keyLength, []).append(t)
+
+    weights = numpy.array(SHIFT_WEIGHTS).T
+    best = {}
+    for keyLength, members in groups.items():
+        c = counts[keyLength][members]
+        total = numpy.maximum(c.sum(axis=2), 1)[:, :, None]
+        chi = (c * c) @ weights / total - total
+        shifts = chi.argmin(axis=2)
+        minima = chi.min(axis=2).sum(axis=1) / keyLength
+        for t, row, score in zip(members, shifts, minima):
+            best[t, keyLength] = (''.join(chr(65 + shift) for shift in row), float(score))
+
+    results = []
+    for t, text in enumerate(texts):
+        ranked = {}
+        for keyLength in chosen[t]:
+            key, score = best[t, keyLength]
+            for period in range(1, keyLength):
+                if keyLength % period == 0 and key == key[:period] * (keyLength // period):
+                    key = key[:period]
+                    break
+            if key not in ranked or score < ranked[key]:
+                ranked[key] = score
+        keys = sorted(ranked.items(), key=lambda item: item[1])
+        results.append((keys, decrypt(text, keys[0][0])))
+    return results
+
+#table used by bytes.translate to uppercase the ciphertext, and the bytes it deletes because they are not letters
+UPPERCASE = bytes.maketrans(bytes(range(97, 123)), bytes(range(65, 91)))
+NOT_LETTERS = bytes(b for b in range(256) if not (65 <= b <= 90 or 97 <= b <= 122))
+
+#function used to read a ciphertext a chunk at a time, with everything but letters stripped and the rest uppercased.
+#source can be a file name (which is memory-mapped), an open binary file, or any bytes-like object such as an mmap
+def readChunks(source, chunkSize=1 << 20):
+    if isinstance(source, str):
+        with open(source, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                yield from readChunks(m, chunkSize)
+        return
+    if hasattr(source, 'read'):
+        chunk = source.read(chunkSize)
+        while chunk:
+            yield chunk.translate(UPPERCASE, NOT_LETTERS)
+            chunk = source.read(chunkSize)
+        return
+    for i in range(0, len(source), chunkSize):
+        yield source[i:i+chunkSize].translate(UPPERCASE, NOT_LETTERS)
+
+#function used to analyse a ciphertext that does not fit in memory. the n-gram table and the column counters are
+#updated one chunk at a time, and only the last ngram-1 letters of each chunk are carried over to the next one,
+#so memory is bounded by the number of distinct n-grams and offsets instead of the length of the text.
+#with allPairs=True every position of every n-gram is kept, so memory grows with the text again.
+#returns the same (offsets, freqs) as kasiski_index with the same allPairs and the same matrices as columnCountsBatch
+def analyze_stream(source, ngram=3, maxDivisor=15, keyLengths=range(2, 16), chunkSize=1 << 20, allPairs=False):
+    seen = {}
+    offsets = {}
+    counts = {keyLength: [[0] * keyLength for i in range(26)] for keyLength in keyLengths}
+    tail = b''
+    position = 0
+    for chunk in readChunks(source, chunkSize):
+        updateOffsets(tail + chunk, seen, offsets, ngram, allPairs, start=position - len(tail))
+        for keyLength in keyLengths:
+            updateColumnCounts(counts[keyLength], chunk, position)
+        position = position + len(chunk)
+        tail = (tail + chunk)[-(ngram - 1):] if ngram > 1 else b''
+    return offsets, divisorFrequency(offsets, maxDivisor), counts
+
+if __name__ == '__main__':
+    #a ciphertext file given on the command line is analysed as a stream instead of the one above
+    if len(sys.argv) > 1:
+        offset, freqs, counts = analyze_stream(sys.argv[1], allPairs=True)
+        keyLength = freqs.index(max(freqs))
+        print('Key length is ' + str(keyLength) + '\n')
+        print('Key is ' + rankKeys(counts)[0][0])
+        sys.exit()
+
+    #put the offset of each matching 3-character tuple in a table and count the divisors of those offsets.
+    #allPairs=True counts every earlier occurrence of a pattern, so the frequencies are the same as before
+    offset, freqs = kasiski_index(ciphertext, allPairs=True)
+
+    #printing the frequencies of divisors 1 < x <= 15
+    print('frequencies of divisors from 2 - 15:')
+    i = 2
+    while i < len(freqs):
+        print(str(i) + ': ' + str(freqs[i]))
         i = i + 1
-    return offset, div
-    
-#function used to find the most common divisor by counting the frequency of each divisor
-def getFrequency(d):
-    #just want frequencies for divisors 1 < x <= 15, since keys are desireably short
-	#the index represents the divisor, the value represents the frequency
-	freqList = [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0]
-	i = 0
-	while i < len(d):
-		for j in d[i]:
-			if j < len(freqList):
-				freqList[j] = freqList[j] + 1
-		i = i + 1
-	return freqList
-
-#put the offset of each matching 3-character tuple in a list and put the divisor of each offset into another list    
-offset, divisors = tupleOffset(split(ciphertext))
-
-#print(getFrequency(divisors)) #test
-
-#printing the frequencies of divisors 1 < x <= 15
-print('frequencies of divisors from 2 - 15:')
-freqs = getFrequency(divisors)
-i = 2
-while i < len(freqs):
-    print(str(i) + ': ' + str(freqs[i]))
-    i = i + 1
-
-maxFreq = max(freqs)
-keyLength = freqs.index(maxFreq) #index corresponds to the divisor
-print('\nKey length is ' + str(keyLength) + '\n')
-
-#now we split the ciphertext into chunks with legth of keyLength
-splitCipher = wrap(ciphertext, keyLength)
-#print(splitCipher)
-
-#This loop just counts the number of letters on the ciphertext
-#used to create the hitograms
-final = []
-for i in range(0, 26): #for every 26 letters in the alphabet
-    row = []
-    for k in range(0, keyLength): 
-	    count = 0
-	    for l in range(0, len(splitCipher)): #scanning through whole ciphertext
-	        text = splitCipher[l]
-	        if text[k] == chr(65+i):
-	            #print(chr(65+i))
-	            #print('match!')
-	            count = count + 1
-	    row.append(int(count))
-    final.append(row)
-
-#just printing the histogram
-print('\nHistograms:')
-for s in range (0,len(final)):
-    print(chr(65+s) + ': ' + str(final[s]))
\ No newline at end of file
+
+    maxFreq = max(freqs)
+    keyLength = freqs.index(maxFreq) #index corresponds to the divisor
+    print('\nKey length is ' + str(keyLength) + '\n')
+
+    #count the letters of each column of the ciphertext, used to create the histograms
+    final = columnCounts(ciphertext, keyLength)
+
+    #just printing the histogram
+    print('\nHistograms:')
+    for s in range (0,len(final)):
+        print(chr(65+s) + ': ' + str(final[s]))
+
+    #recover the key from the histograms and decrypt the ciphertext with it
+    keys, plaintext = recover_key(ciphertext)
+    print('\nKey is ' + keys[0][0])
+    print('\nPlaintext:\n' + plaintext)
\ No newline at end of file
@@ -0,0 +1,251 @@
+"""
+Microbenchmarks for the schemes, primitives and the Vigenere analysis
+"""
+
+import os, sys, gc, json, time, random, statistics, tracemalloc
+import importlib.util
+
+"""
+Each benchmark is a call with no arguments, for example Enc on a fixed key
+and message, and gets fresh ideal primitives so that tables grown by
+earlier benchmarks do not slow it down. It is run once to warm up. Then
+the number of calls per sample is doubled until one sample takes MIN_TIME
+seconds, and SAMPLES samples are timed with the garbage collector off.
+As with timeit, the best sample gives the rate in ops/s, since slower
+samples mostly measure interference from the rest of the machine. The
+relative standard deviation of the samples is reported alongside. Memory
+is the peak traced by tracemalloc during one further call. This includes
+any growth of the ideal primitives' lazy tables.
+
+Results are compared with the baseline in BASELINE. A benchmark is flagged
+as a regression when its rate drops below the baseline by more than
+THRESHOLD or three standard deviations, whichever is larger, or when its
+peak memory grows by more than THRESHOLD. In that case the script exits
+with status 1.
+
+Usage:
+
+    python benchmark.py                  run and compare with the baseline
+    python benchmark.py --save           run and store the results as the baseline
+    python benchmark.py Ind-CPA Vigenere run only benchmarks whose names contain
+                                         one of the words
+    python benchmark.py --baseline=FILE  use FILE instead of BASELINE
+    python benchmark.py --threshold=0.3  tolerate larger drops, on noisy machines
+"""
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+BASELINE = os.path.join(HERE, "benchmark_baseline.json")
+SAMPLES = 5
+MIN_TIME = 0.1
+THRESHOLD = 0.2
+
+scripts = {}
+
+def load_script(filename):
+    """
+    Imports one of the hyphenated scripts without running its __main__ block.
+    """
+    if filename not in scripts:
+        name = filename[:-3].replace("-", "_").lower()
+        spec = importlib.util.spec_from_file_location(name, os.path.join(HERE, filename))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        scripts[filename] = module
+    return scripts[filename]
+
+def timed(fn, loops):
+    """
+    Times loops calls with the garbage collector off, as timeit does.
+    """
+    gc.collect()
+    gc.disable()
+    try:
+        start = time.perf_counter()
+        for i in range(loops):
+            fn()
+        return time.perf_counter() - start
+    finally:
+        gc.enable()
+
+def measure(fn):
+    """
+    :return: {"ops": best calls per second, "rsd": relative standard
+    deviation of the samples, "peak_bytes": peak memory of one call}
+    """
+    fn()
+    loops = 1
+    while timed(fn, loops) < MIN_TIME:
+        loops *= 2
+    rates = [loops / timed(fn, loops) for i in range(SAMPLES)]
+    tracemalloc.start()
+    fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {"ops": max(rates), "rsd": statistics.stdev(rates) / statistics.mean(rates), "peak_bytes": peak}
+
+"""
+Benchmark groups. Each one is a generator of (name, fn) taking a predicate
+wanted(name), and skips the setup of every benchmark that is not wanted. It
+sets the script's module globals just before yielding a benchmark, so
+every benchmark has to be measured before the next one is taken.
+"""
+
+def hash_functions(wanted):
+    hf = load_script("Hash-Functions.py")
+    hf.k_bytes = 16
+    hf.n_bytes = 8
+    K = hf.random_string(hf.k_bytes)
+    for size in (64, 1024, 16384):
+        for (name, fn, decrypt) in (("Enc", hf.Enc, False), ("Dec", hf.Dec, True),
+                                    ("Enc_fast", hf.Enc_fast, False), ("Dec_fast", hf.Dec_fast, True)):
+            name = "Hash-Functions %s %dB" % (name, size)
+            if not wanted(name):
+                continue
+            hf.F = hf.FunctionFamily(hf.k_bytes, hf.n_bytes, hf.n_bytes).evaluate
+            M = hf.random_string(size)
+            X = hf.Enc(K, M) if decrypt else M
+            yield (name, lambda: fn(K, X))
+    name = "Hash-Functions Dec_fast 64x1024B"
+    if wanted(name):
+        hf.F = hf.FunctionFamily(hf.k_bytes, hf.n_bytes, hf.n_bytes).evaluate
+        Cs = [hf.Enc(K, hf.random_string(1024)) for i in range(64)]
+        yield (name, lambda: [hf.Dec_fast(K, C) for C in Cs])
+    for size in (64, 1024, 16384):
+        for (name, fn) in (("H1", hf.H1), ("H2", hf.H2), ("H1_fast", hf.H1_fast), ("H2_fast", hf.H2_fast)):
+            name = "Hash-Functions %s %dB" % (name, size)
+            if not wanted(name):
+                continue
+            hf.configure(128, 128)
+            K = hf.random_string(hf.k_bytes)
+            M = hf.random_string(size)
+            yield (name, lambda: fn(K, M))
+
+def int_ctxt(wanted):
+    ic = load_script("Int-Ctxt-Game.py")
+    for (name, decrypt) in (("Int-Ctxt Enc", False), ("Int-Ctxt Dec", True)):
+        if not wanted(name):
+            continue
+        ic.configure(128, 128)
+        K = ic.random_string(ic.k_bytes)
+        M = ic.random_string(ic.n_bytes)
+        if decrypt:
+            C = ic.Enc(K, M)
+            yield (name, lambda: ic.Dec(K, C))
+        else:
+            yield (name, lambda: ic.Enc(K, M))
+
+def ind_cpa(wanted):
+    cpa = load_script("Ind-CPA-Game.py")
+    # Time key generation itself. Through the prime pool, K would only
+    # measure how fast the pool drains, and its workers would compete with
+    # the later benchmarks for the CPU.
+    cpa.USE_PRIME_POOL = False
+    for k in (64, 256, 512, 1024, 2048):
+        names = ["Ind-CPA %s k=%d" % (name, k) for name in ("K", "E", "D")]
+        if not any(map(wanted, names)):
+            continue
+        cpa.k = k
+        (pk, sk) = cpa.K()
+        M = cpa.random_Z_N_star(pk[0])
+        C = cpa.E(pk, M)
+        for (name, fn) in zip(names, (cpa.K, lambda: cpa.E(pk, M), lambda: cpa.D(sk, C))):
+            if wanted(name):
+                yield (name, fn)
+
+def uf_cma(wanted):
+    uf = load_script("Uf-CMA-Game.py")
+    for j in (64, 256, 512):
+        names = ["Uf-CMA %s j=%d" % (name, j) for name in ("K1", "E1", "D1", "T")]
+        if not any(map(wanted, names)):
+            continue
+        (uf.p, uf.q, uf.g) = uf.group_params(j)
+        (pk, sk) = uf.K1()
+        M = uf.random_Z_N_star(uf.p)
+        C = uf.E1(pk, M)
+        K = uf.kgen()
+        X = uf.random_Z_N_star(uf.p - 1)
+        for (name, fn) in zip(names, (uf.K1, lambda: uf.E1(pk, M), lambda: uf.D1(sk, C), lambda: uf.T(K, X))):
+            if wanted(name):
+                yield (name, fn)
+
+def vigenere(wanted):
+    vc = load_script("Vignere-Cipher-Helper.py")
+    rng = random.Random(0)
+    # Encrypting under FOUNDIT is decrypting under its negation.
+    inverse = "".join(chr(65 + (26 - (ord(c) - 65)) % 26) for c in "FOUNDIT")
+    for size in (1000, 16000, 256000):
+        # Draw the text even when skipped, so each size keeps its text.
+        plaintext = "".join(rng.choices([chr(c) for c in vc.LETTERS], weights=vc.ENGLISH, k=size))
+        names = ["Vigenere %s %d" % (name, size) for name in ("kasiski_index", "recover_key")]
+        if not any(map(wanted, names)):
+            continue
+        text = vc.decrypt(plaintext, inverse)
+        for (name, fn) in zip(names, (lambda: vc.kasiski_index(text), lambda: vc.recover_key(text))):
+            if wanted(name):
+                yield (name, fn)
+    name = "Vigenere recover_keys 256x1000"
+    if wanted(name):
+        texts = [vc.decrypt("".join(rng.choices([chr(c) for c in vc.LETTERS], weights=vc.ENGLISH, k=1000)), inverse)
+                 for i in range(256)]
+        yield (name, lambda: vc.recover_keys(texts))
+
+GROUPS = [hash_functions, int_ctxt, ind_cpa, uf_cma, vigenere]
+
+def compare(result, base, threshold=THRESHOLD):
+    """
+    :return: a note on how result compares with the baseline entry base,
+    and whether it is a regression
+    """
+    if base is None:
+        return ("new", False)
+    ratio = result["ops"] / base["ops"]
+    slower = ratio < 1 - max(threshold, 3 * max(result["rsd"], base["rsd"]))
+    bigger = result["peak_bytes"] > (1 + threshold) * base["peak_bytes"] + 1024
+    note = "%.2fx" % ratio
+    if slower:
+        note += " SLOWER"
+    if bigger:
+        note += " MORE MEMORY"
+    return (note, slower or bigger)
+
+def main(argv):
+    save = "--save" in argv
+    path = BASELINE
+    threshold = THRESHOLD
+    words = []
+    for arg in argv:
+        if arg.startswith("--baseline="):
+            path = arg[len("--baseline="):]
+        elif arg.startswith("--threshold="):
+            threshold = float(arg[len("--threshold="):])
+        elif not arg.startswith("--"):
+            words.append(arg)
+    baseline = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            baseline = json.load(f)["results"]
+
+    results = {}
+    regressions = 0
+    print("%-36s %12s %7s %10s  %s" % ("benchmark", "ops/s", "rsd", "peak KiB", "vs baseline"))
+    wanted = lambda name: not words or any(word in name for word in words)
+    for group in GROUPS:
+        for (name, fn) in group(wanted):
+            result = results[name] = measure(fn)
+            (note, regression) = compare(result, baseline.get(name), threshold)
+            regressions += regression
+            print("%-36s %12.1f %6.1f%% %10.1f  %s" % (name, result["ops"], 100 * result["rsd"],
+                                                      result["peak_bytes"] / 1024, note))
+
+    if save:
+        baseline.update(results)
+        with open(path, "w") as f:
+            json.dump({"python": sys.version.split()[0], "results": baseline}, f, indent=1, sort_keys=True)
+        print("Saved the baseline to " + path)
+    elif regressions:
+        print("%d regressions against %s" % (regressions, path))
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
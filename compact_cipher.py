@@ -0,0 +1,255 @@
+"""
+Compact ideal blockcipher for exhaustive runs
+"""
+
+import random, hashlib
+from array import array
+
+import randomness
+
+"""
+CompactBlockCipher has the interface of playcrypt's ideal BlockCipher
+(encrypt and decrypt on strings) but keeps its permutations in packed
+storage instead of dicts of Python strings, which cost hundreds of bytes
+per key and per entry.
+
+Points are sampled lazily, as BlockCipher does. All keys share one
+PackedMap per direction, keyed by K || X, so a key costs nothing beyond
+its entries. The image of a new point is drawn by hashing it with the
+cipher's salt. It is redrawn only if that value is already taken, so
+apart from such collisions an answer depends on the salt, the key and the
+point, and not on the order of queries. A cipher built with a seed derives
+its salt from the seed. Processes and later runs that use the same seed
+then agree on it, so work split over several processes sees one cipher.
+
+Blocks of at most DENSE_MAX_BYTES bytes can be stored densely. A key is
+moved to two arrays, its permutation and its inverse, once it has sampled
+so many points that its packed entries would take more room than the
+arrays. The points it has not sampled yet are then filled in with a
+shuffle of the unused values. Keys that see a few queries each, such as
+the keys of individual games, therefore stay packed. Small blocks collide
+too often for lazy sampling to be independent of the query order, so a
+seeded cipher draws every key's whole permutation by the shuffle alone,
+the first time the key is used.
+"""
+
+DENSE_MAX_BYTES = 2
+
+class PackedMap(object):
+    """
+    Open-addressing hash map from key_width-byte strings to value_width-byte
+    strings, with linear probing, kept between an eighth and a half full.
+    The used flags, keys and values sit in three bytearrays, so a slot costs
+    key_width + value_width + 1 bytes.
+    """
+
+    __slots__ = ("key_width", "value_width", "size", "capacity", "used", "keys", "values")
+
+    def __init__(self, key_width, value_width, capacity=4):
+        self.key_width = key_width
+        self.value_width = value_width
+        self.size = 0
+        self.allocate(capacity)
+
+    def allocate(self, capacity):
+        self.capacity = capacity
+        self.used = bytearray(capacity)
+        self.keys = bytearray(capacity * self.key_width)
+        self.values = bytearray(capacity * self.value_width)
+
+    def slot(self, key):
+        w = self.key_width
+        mask = self.capacity - 1
+        used = self.used
+        keys = self.keys
+        i = hash(key) & mask
+        while used[i] and keys[i * w:(i + 1) * w] != key:
+            i = (i + 1) & mask
+        return i
+
+    def get(self, key):
+        """
+        :param key: key_width-byte bytes
+        :return: the stored value as bytes, or None
+        """
+        i = self.slot(key)
+        if not self.used[i]:
+            return None
+        v = self.value_width
+        return bytes(self.values[i * v:(i + 1) * v])
+
+    def resize(self, capacity):
+        w = self.key_width
+        v = self.value_width
+        used, keys, values = self.used, self.keys, self.values
+        self.allocate(capacity)
+        for j in range(len(used)):
+            if used[j]:
+                i = self.slot(bytes(keys[j * w:(j + 1) * w]))
+                self.used[i] = 1
+                self.keys[i * w:(i + 1) * w] = keys[j * w:(j + 1) * w]
+                self.values[i * v:(i + 1) * v] = values[j * v:(j + 1) * v]
+
+    def put(self, key, value):
+        w = self.key_width
+        v = self.value_width
+        if 2 * (self.size + 1) > self.capacity:
+            self.resize(2 * self.capacity)
+        i = self.slot(key)
+        if not self.used[i]:
+            self.used[i] = 1
+            self.size += 1
+        self.keys[i * w:(i + 1) * w] = key
+        self.values[i * v:(i + 1) * v] = value
+
+    def remove(self, key):
+        """
+        Deletes key if it is present. The entries after it in its probe run
+        are shifted back into the hole wherever their own probe allows, so
+        that no lookup stops early, and the arrays shrink once at most an
+        eighth of the slots are used.
+        """
+        w = self.key_width
+        v = self.value_width
+        mask = self.capacity - 1
+        used, keys, values = self.used, self.keys, self.values
+        i = self.slot(key)
+        if not used[i]:
+            return
+        used[i] = 0
+        self.size -= 1
+        j = i
+        while True:
+            j = (j + 1) & mask
+            if not used[j]:
+                break
+            home = hash(bytes(keys[j * w:(j + 1) * w])) & mask
+            if (i < home <= j) if i <= j else (home > i or home <= j):
+                continue
+            used[i] = 1
+            keys[i * w:(i + 1) * w] = keys[j * w:(j + 1) * w]
+            values[i * v:(i + 1) * v] = values[j * v:(j + 1) * v]
+            used[j] = 0
+            i = j
+        if self.capacity > 4 and 8 * self.size <= self.capacity:
+            self.resize(self.capacity // 2)
+
+    def __len__(self):
+        return self.size
+
+class CompactBlockCipher(object):
+    def __init__(self, key_len, block_len, seed=None):
+        """
+        :param key_len: key length in bytes
+        :param block_len: block length in bytes
+        :param seed: any value with a str form, from which the salt is
+        derived; the salt is drawn from the randomness source if None
+        """
+        self.key_len = key_len
+        self.block_len = block_len
+        self.seed = seed
+        self.seeded = seed is not None
+        self.salt = hashlib.sha256(str(seed).encode()).digest() if self.seeded else randomness.random_bytes(32)
+        self.maps = (PackedMap(key_len + block_len, block_len), PackedMap(key_len + block_len, block_len))
+        self.dense = {}
+        self.dense_after = None
+        if block_len <= DENSE_MAX_BYTES and self.seeded:
+            self.dense_after = 0
+        elif block_len <= DENSE_MAX_BYTES:
+            # A packed point takes a slot in each map, and a map is between
+            # a quarter and half full, so about three slots each.
+            entry = key_len + 2 * block_len + 1
+            self.dense_after = max(1, (1 << 8 * block_len) * block_len // (3 * entry))
+            self.counts = PackedMap(key_len, 4)
+
+    def check(self, k, x):
+        if len(k) != self.key_len:
+            raise ValueError("Key must be of length %d bytes." % self.key_len)
+        if len(x) != self.block_len:
+            raise ValueError("Block must be of length %d bytes." % self.block_len)
+
+    def draw(self, point, direction, attempt):
+        return hashlib.shake_256(self.salt + b"%d:%d:" % (direction, attempt) + point).digest(self.block_len)
+
+    def sample(self, k, x, direction):
+        """
+        Lazily samples the image of x in the given direction (0 encrypts,
+        1 decrypts) under key k, avoiding values already taken.
+        """
+        k = k.encode("latin-1")
+        point = k + x.encode("latin-1")
+        y = self.maps[direction].get(point)
+        if y is None:
+            attempt = 0
+            y = self.draw(point, direction, attempt)
+            while self.maps[1 - direction].get(k + y) is not None:
+                attempt += 1
+                y = self.draw(point, direction, attempt)
+            self.maps[direction].put(point, y)
+            self.maps[1 - direction].put(k + y, point[self.key_len:])
+            if self.dense_after is not None:
+                count = int.from_bytes(self.counts.get(k) or bytes(4), "big") + 1
+                self.counts.put(k, count.to_bytes(4, "big"))
+                if count >= self.dense_after:
+                    self.densify(k)
+        return y.decode("latin-1")
+
+    def densify(self, k):
+        """
+        Moves key k, as bytes, to dense tables that agree with every point
+        it has sampled, and removes its packed entries.
+
+        :return: the (forward, inverse) arrays
+        """
+        n = self.block_len
+        size = 1 << (8 * n)
+        typecode = "B" if n == 1 else "H"
+        forward = array(typecode, bytes(size * n))
+        inverse = array(typecode, bytes(size * n))
+        known = bytearray(size)
+        taken = bytearray(size)
+        for x in range(size):
+            y = self.maps[0].get(k + x.to_bytes(n, "big"))
+            if y is not None:
+                y = int.from_bytes(y, "big")
+                forward[x] = y
+                inverse[y] = x
+                known[x] = taken[y] = 1
+        free = [y for y in range(size) if not taken[y]]
+        random.Random(self.salt + k).shuffle(free)
+        for x in range(size):
+            if known[x]:
+                self.maps[0].remove(k + x.to_bytes(n, "big"))
+                self.maps[1].remove(k + forward[x].to_bytes(n, "big"))
+        if self.dense_after:
+            self.counts.remove(k)
+        for (x, y) in zip((x for x in range(size) if not known[x]), free):
+            forward[x] = y
+            inverse[y] = x
+        tables = self.dense[k.decode("latin-1")] = (forward, inverse)
+        return tables
+
+    def tables(self, k):
+        """
+        :return: the dense tables of key k, or None while it is packed
+        """
+        tables = self.dense.get(k)
+        if tables is None and self.dense_after == 0:
+            tables = self.densify(k.encode("latin-1"))
+        return tables
+
+    def encrypt(self, k, m):
+        self.check(k, m)
+        tables = self.tables(k)
+        if tables is not None:
+            return int.to_bytes(tables[0][int.from_bytes(m.encode("latin-1"), "big")],
+                                self.block_len, "big").decode("latin-1")
+        return self.sample(k, m, 0)
+
+    def decrypt(self, k, c):
+        self.check(k, c)
+        tables = self.tables(k)
+        if tables is not None:
+            return int.to_bytes(tables[1][int.from_bytes(c.encode("latin-1"), "big")],
+                                self.block_len, "big").decode("latin-1")
+        return self.sample(k, c, 1)
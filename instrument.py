@@ -0,0 +1,199 @@
+"""
+Oracle-call instrumentation for the game simulations
+"""
+
+import os, json, time
+
+"""
+Counts the calls, bytes and time spent in primitives such as E, E_I, F,
+MOD_EXP and MOD_INV, and in the game oracles (fn, lr, enc, tag), so that
+the query and time bounds claimed for each adversary can be checked.
+
+Instrumentation is on when the environment variable INSTRUMENT_JSON names
+an output file. When it is off, wrap returns the function it is given and
+instrument_game leaves the game alone, so nothing is added to any call.
+
+For every name the recorder keeps:
+    calls, bytes (total size of the string and integer arguments) and
+    seconds in total,
+    a latency histogram whose bucket b counts calls that took fewer than
+    2^b nanoseconds,
+    the most and the mean number of calls and bytes per adversary run, over
+    the runs that made any calls. A run lasts from the initialization of an instrumented
+    game until its finalization, and calls made outside any run only count
+    towards the totals.
+
+Recordings made in trial_runner and sweep workers are sent back with their
+results and merged, and dump() writes the totals as JSON.
+
+Usage, in a script:
+
+    instrument_globals(globals(), "E", "E_I")
+    g = instrument_game(GameKR(3, F, k_bytes+n_bytes, n_bytes), "fn")
+    ...
+    dump()
+"""
+
+class Recorder(object):
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.stats = {}
+        self.per_run = {}
+        self.current = {}
+        self.runs = 0
+        self.active = False
+
+    def entry(self, name):
+        stats = self.stats.get(name)
+        if stats is None:
+            stats = self.stats[name] = {"calls": 0, "bytes": 0, "seconds": 0.0, "histogram": {}}
+        return stats
+
+    def record(self, name, size, elapsed):
+        """
+        :param elapsed: duration of the call in nanoseconds
+        """
+        stats = self.entry(name)
+        stats["calls"] += 1
+        stats["bytes"] += size
+        stats["seconds"] += elapsed / 1e9
+        bucket = str(elapsed.bit_length())
+        stats["histogram"][bucket] = stats["histogram"].get(bucket, 0) + 1
+        if self.active:
+            (calls, total) = self.current.get(name, (0, 0))
+            self.current[name] = (calls + 1, total + size)
+
+    def new_run(self):
+        self.end_run()
+        self.runs += 1
+        self.active = True
+
+    def end_run(self):
+        for (name, (calls, size)) in self.current.items():
+            (runs, total, peak, total_bytes, peak_bytes) = self.per_run.get(name, (0, 0, 0, 0, 0))
+            self.per_run[name] = (runs + 1, total + calls, max(peak, calls),
+                                  total_bytes + size, max(peak_bytes, size))
+        self.current = {}
+        self.active = False
+
+    def take(self):
+        """
+        :return: everything recorded so far, in the form merge expects, and
+        starts over
+        """
+        self.end_run()
+        snapshot = {"runs": self.runs, "stats": self.stats, "per_run": self.per_run}
+        self.clear()
+        return snapshot
+
+    def merge(self, snapshot):
+        self.runs += snapshot["runs"]
+        for (name, other) in snapshot["stats"].items():
+            stats = self.entry(name)
+            for field in ("calls", "bytes", "seconds"):
+                stats[field] += other[field]
+            for (bucket, count) in other["histogram"].items():
+                stats["histogram"][bucket] = stats["histogram"].get(bucket, 0) + count
+        for (name, (runs, total, peak, total_bytes, peak_bytes)) in snapshot["per_run"].items():
+            (r, t, m, tb, mb) = self.per_run.get(name, (0, 0, 0, 0, 0))
+            self.per_run[name] = (r + runs, t + total, max(m, peak), tb + total_bytes, max(mb, peak_bytes))
+
+    def report(self):
+        self.end_run()
+        report = {"runs": self.runs, "calls": {}}
+        for (name, stats) in sorted(self.stats.items()):
+            entry = dict(stats)
+            entry["histogram"] = dict(sorted(stats["histogram"].items(), key=lambda item: int(item[0])))
+            (runs, total, peak, total_bytes, peak_bytes) = self.per_run.get(name, (0, 0, 0, 0, 0))
+            entry["max_per_run"] = peak
+            entry["mean_per_run"] = total / runs if runs else None
+            entry["max_bytes_per_run"] = peak_bytes
+            entry["mean_bytes_per_run"] = total_bytes / runs if runs else None
+            report["calls"][name] = entry
+        return report
+
+OUTPUT = os.environ.get("INSTRUMENT_JSON")
+recorder = Recorder() if OUTPUT else None
+if recorder:
+    # A forked worker reports only its own calls.
+    os.register_at_fork(after_in_child=recorder.clear)
+
+def size_of(value):
+    if isinstance(value, int):
+        return (value.bit_length() + 7) // 8
+    if isinstance(value, (str, bytes, bytearray)):
+        return len(value)
+    if isinstance(value, (tuple, list)):
+        return sum(size_of(item) for item in value)
+    return 0
+
+def wrap(name, fn):
+    """
+    :return: fn recording its calls under name, or fn itself when
+    instrumentation is off
+    """
+    if recorder is None:
+        return fn
+    clock = time.perf_counter_ns
+    def wrapped(*args):
+        start = clock()
+        result = fn(*args)
+        recorder.record(name, size_of(args), clock() - start)
+        return result
+    wrapped.__wrapped__ = fn
+    return wrapped
+
+def instrument_globals(namespace, *names):
+    """
+    Rebinds each named function in namespace, usually globals(), to its
+    wrapped version, so every caller in the module goes through it.
+    """
+    if recorder is None:
+        return
+    for name in names:
+        if not hasattr(namespace[name], "__wrapped__"):
+            namespace[name] = wrap(name, namespace[name])
+
+def instrument_game(game, *oracles):
+    """
+    Wraps the named oracles of game, and makes game.initialize and
+    game.finalize start and end an adversary run.
+
+    :return: game
+    """
+    if recorder is None:
+        return game
+    for name in oracles:
+        setattr(game, name, wrap(name, getattr(game, name)))
+    initialize = game.initialize
+    finalize = game.finalize
+    def wrapped_initialize(*args, **kwargs):
+        recorder.new_run()
+        return initialize(*args, **kwargs)
+    def wrapped_finalize(*args, **kwargs):
+        try:
+            return finalize(*args, **kwargs)
+        finally:
+            recorder.end_run()
+    game.initialize = wrapped_initialize
+    game.finalize = wrapped_finalize
+    return game
+
+def take():
+    return recorder.take() if recorder else None
+
+def merge(snapshot):
+    if recorder and snapshot:
+        recorder.merge(snapshot)
+
+def dump(path=None):
+    """
+    Writes the report as JSON to path, INSTRUMENT_JSON by default, when
+    instrumentation is on.
+    """
+    if recorder is None:
+        return
+    with open(path or OUTPUT, "w") as f:
+        json.dump(recorder.report(), f, indent=1)
@@ -0,0 +1,75 @@
+"""
+Prime testing and modular inversion shared by the public-key scripts
+"""
+
+import random
+
+"""
+Ind-CPA-Game.py generates RSA primes and Uf-CMA-Game.py safe-prime groups
+with the same Miller-Rabin test and trial division, and both invert many
+elements at once with Montgomery's trick. The arithmetic uses Python's
+pow directly, so calls made here are not counted by instrumentation of a
+script's MOD_EXP and MOD_INV.
+"""
+
+SMALL_PRIMES = [r for r in range(3, 1000) if all(r % t for t in range(2, int(r ** 0.5) + 1))]
+
+def has_small_factor(n):
+    """
+    :return: True if an odd prime below 1000 divides n and is not n itself
+    """
+    return any(n % r == 0 and n != r for r in SMALL_PRIMES)
+
+def is_probable_prime(n, rng=random, rounds=40):
+    """
+    Miller-Rabin test.
+
+    :param n: integer to test
+    :param rng: source of the random bases, with a randrange method
+    :param rounds: number of random bases
+    :return: True if n is prime with probability at least 1 - 4^(-rounds)
+    """
+    if n < 3:
+        return n == 2
+    for r in SMALL_PRIMES:
+        if n % r == 0:
+            return n == r
+    d, s = n - 1, 0
+    while d % 2 == 0:
+        d, s = d // 2, s + 1
+    for i in range(rounds):
+        x = pow(rng.randrange(2, n - 1), d, n)
+        if x == 1 or x == n - 1:
+            continue
+        for j in range(s - 1):
+            x = pow(x, 2, n)
+            if x == n - 1:
+                break
+        else:
+            return False
+    return True
+
+def batch_inverse(values, N):
+    """
+    Montgomery's trick: n inverses for one inversion and 3(n-1)
+    multiplications.
+
+    :param values: list of elements of Z_N^*
+    :param N: modulus
+    :return: list of the inverses of values mod N
+    """
+    if not values:
+        return []
+    prefix = [values[0]]
+    for v in values[1:]:
+        prefix.append(prefix[-1] * v % N)
+    try:
+        inv = pow(prefix[-1], -1, N)
+    except ValueError:
+        raise ValueError("Inverse does not exist.")
+    result = [0] * len(values)
+    for i in range(len(values) - 1, 0, -1):
+        result[i] = inv * prefix[i - 1] % N
+        inv = inv * values[i] % N
+    result[0] = inv
+    return result
@@ -0,0 +1,159 @@
+"""
+Memoizing oracle layer for the ideal primitives
+"""
+
+import os
+from collections import OrderedDict
+
+"""
+CachedFunctionFamily and CachedBlockCipher wrap a playcrypt FunctionFamily or
+BlockCipher, or a CompactBlockCipher, and answer repeated (K, X) queries
+from their own tables. The tables are grouped per key. Keys and the points
+of each key are both kept in LRU order, so at most max_keys keys with at
+most max_entries points each are cached. The wrapped primitive stays the
+source of truth. A miss is always forwarded to it, so evicting an entry
+never changes an answer. For a blockcipher every answer is stored in both
+the forward and the inverse table, which keeps encrypt and decrypt
+consistent.
+
+Caching is opt-in: it is on when the environment variable ORACLE_CACHE is
+set. When it is off, cached returns the primitive it is given and
+clear_on_initialize leaves the game alone, so nothing is added to any call.
+Hits and misses are counted per cache, and report() prints the counters of
+every cache made in this process. Caches made in trial_runner and sweep
+workers count only there.
+
+Usage, where a script binds its primitives:
+
+    EE = cached(BlockCipher(k_bytes, n_bytes))
+    E = EE.encrypt
+    E_I = EE.decrypt
+    g = clear_on_initialize(GameKR(3, F, k_bytes + n_bytes, n_bytes), EE)
+    ...
+    report()
+"""
+
+ENABLED = bool(os.environ.get("ORACLE_CACHE"))
+caches = []
+
+class OracleCache(object):
+    def __init__(self, primitive, max_keys=64, max_entries=1 << 16):
+        """
+        :param primitive: the FunctionFamily or blockcipher to wrap
+        :param max_keys: number of keys whose tables are kept
+        :param max_entries: number of points kept per key and direction
+        """
+        self.primitive = primitive
+        self.max_keys = max_keys
+        self.max_entries = max_entries
+        self.tables = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        caches.append(self)
+
+    def __getattr__(self, name):
+        # Attributes such as key_len or seed come from the wrapped primitive.
+        if name == "primitive":
+            raise AttributeError(name)
+        return getattr(self.primitive, name)
+
+    def tables_of(self, K):
+        """
+        :return: the (forward, inverse) tables of key K, created if needed
+        and marked as most recently used
+        """
+        tables = self.tables.get(K)
+        if tables is None:
+            tables = self.tables[K] = (OrderedDict(), OrderedDict())
+            if len(self.tables) > self.max_keys:
+                self.tables.popitem(last=False)
+        else:
+            self.tables.move_to_end(K)
+        return tables
+
+    def store(self, table, X, Y):
+        table[X] = Y
+        if len(table) > self.max_entries:
+            table.popitem(last=False)
+
+    def lookup(self, K, X, direction, compute):
+        tables = self.tables_of(K)
+        table = tables[direction]
+        Y = table.get(X)
+        if Y is None:
+            self.misses += 1
+            Y = compute(K, X)
+            self.store(table, X, Y)
+            if self.invertible:
+                self.store(tables[1 - direction], Y, X)
+        else:
+            self.hits += 1
+            table.move_to_end(X)
+        return Y
+
+    def clear(self):
+        """
+        Drops every cached point; the counters are kept.
+        """
+        self.tables.clear()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "keys": len(self.tables)}
+
+class CachedFunctionFamily(OracleCache):
+    invertible = False
+
+    def evaluate(self, K, X):
+        return self.lookup(K, X, 0, self.primitive.evaluate)
+
+class CachedBlockCipher(OracleCache):
+    invertible = True
+
+    def encrypt(self, K, M):
+        return self.lookup(K, M, 0, self.primitive.encrypt)
+
+    def decrypt(self, K, C):
+        return self.lookup(K, C, 1, self.primitive.decrypt)
+
+def cached(primitive, max_keys=64, max_entries=1 << 16):
+    """
+    :param primitive: a FunctionFamily, or a blockcipher with encrypt and
+    decrypt
+    :return: primitive behind a cache, or primitive itself when caching is
+    off
+    """
+    if not ENABLED:
+        return primitive
+    if hasattr(primitive, "evaluate"):
+        return CachedFunctionFamily(primitive, max_keys, max_entries)
+    return CachedBlockCipher(primitive, max_keys, max_entries)
+
+def clear_on_initialize(game, *primitives):
+    """
+    Makes game.initialize clear the caches among primitives before a new
+    game starts. Primitives that are not cached are ignored.
+
+    :param game: any playcrypt game
+    :return: game
+    """
+    targets = [p for p in primitives if isinstance(p, OracleCache)]
+    if not targets:
+        return game
+    initialize = game.initialize
+    def wrapped(*args, **kwargs):
+        for cache in targets:
+            cache.clear()
+        return initialize(*args, **kwargs)
+    game.initialize = wrapped
+    return game
+
+def report():
+    """
+    Prints the hit and miss counters of every cache made in this process,
+    when caching is on.
+    """
+    for cache in caches:
+        print("%s(%s): %s" % (type(cache).__name__, type(cache.primitive).__name__, cache.stats()))
@@ -0,0 +1,170 @@
+"""
+Pluggable randomness source for the schemes and adversaries
+"""
+
+import os, sys, random, hashlib, math, weakref
+
+"""
+The scripts import random_string and random_Z_N_star from here instead of
+from playcrypt. Both draw from the current source:
+
+OSRandom, the default, asks the operating system on every call, which is
+the same as playcrypt.
+
+CounterPRG expands a seed with SHAKE-256 in counter mode, buffer_size bytes
+per block, and hands the bytes out from a buffer. That costs one hash per
+few kilobytes instead of one system call per draw, and a run is
+reproducible from its seed. A stream number separates independent streams
+that share a seed. Every generator in a forked child switches to a stream
+tied to the child's pid, so workers never repeat each other's bytes.
+
+Making a CounterPRG built with an explicit seed the source also routes
+playcrypt through it: random_string and random_Z_N_star are replaced in
+every playcrypt module loaded at that point, so game keys and the lazy
+sampling of the ideal primitives draw from the seed too, and the random
+module is seeded from it. The scripts take the seed from the environment
+variable RANDOM_SEED and are unseeded without it. RSA primes in
+Ind-CPA-Game.py are the exception: they always come from the operating
+system.
+
+Usage, in a script's __main__:
+
+    use(CounterPRG(SEED))
+
+trial_runner and sweep reseed the current source for every batch of trials
+and every cell, in the same way as they seed the random module. A seeded
+run in one process therefore repeats exactly, and so do the scripts'
+sweeps, whose cells run their trials in one worker each. When trials are
+spread over several processes, batches go to whichever worker is free, so
+an ideal primitive shared by the games of a worker samples its points in a
+different order from run to run, and the estimate varies within its
+confidence interval.
+"""
+
+SEED = os.environ.get("RANDOM_SEED")
+
+class OSRandom(object):
+    def read(self, n):
+        return os.urandom(n)
+
+    def reseed(self, seed, stream=0):
+        pass
+
+class CounterPRG(object):
+    def __init__(self, seed=None, stream=0, buffer_size=4096):
+        """
+        :param seed: any value with a str form; drawn at random if None
+        :param stream: selects one of the independent streams of the seed
+        :param buffer_size: bytes produced per hash call
+        """
+        self.buffer_size = buffer_size
+        self.seeded = seed is not None
+        if seed is None:
+            seed = int.from_bytes(os.urandom(16), "big")
+        self.reseed(seed, stream)
+
+    def reseed(self, seed, stream=0):
+        """
+        Restarts the generator on the given seed and stream.
+        """
+        self.seed = seed
+        self.stream = stream
+        self.key = hashlib.sha256(("%s:%s" % (seed, stream)).encode()).digest()
+        self.counter = 0
+        self.buffer = b""
+        self.offset = 0
+        generators.add(self)
+
+    def block(self):
+        data = hashlib.shake_256(self.key + self.counter.to_bytes(8, "big")).digest(self.buffer_size)
+        self.counter += 1
+        return data
+
+    def read(self, n):
+        """
+        :return: the next n bytes of the stream
+        """
+        offset = self.offset
+        end = offset + n
+        if end <= len(self.buffer):
+            self.offset = end
+            return self.buffer[offset:end]
+        chunks = [self.buffer[offset:]]
+        need = n - len(chunks[0])
+        while need > 0:
+            chunks.append(self.block())
+            need -= self.buffer_size
+        self.buffer = b"".join(chunks)
+        self.offset = n
+        return self.buffer[:n]
+
+generators = weakref.WeakSet()
+
+def _after_fork():
+    for generator in list(generators):
+        generator.reseed(generator.seed, (generator.stream, os.getpid()))
+
+os.register_at_fork(after_in_child=_after_fork)
+
+source = OSRandom()
+
+_playcrypt_originals = {}
+
+def route_playcrypt(routed):
+    """
+    Replaces random_string and random_Z_N_star in the loaded playcrypt
+    modules with the ones here, or puts playcrypt's back.
+    """
+    ours = {"random_string": random_string, "random_Z_N_star": random_Z_N_star}
+    for (name, module) in list(sys.modules.items()):
+        if module is None or not (name == "playcrypt" or name.startswith("playcrypt.")):
+            continue
+        for (attr, fn) in ours.items():
+            current = getattr(module, attr, None)
+            if current is None:
+                continue
+            if routed and current is not fn:
+                _playcrypt_originals[(name, attr)] = current
+                setattr(module, attr, fn)
+            elif not routed and (name, attr) in _playcrypt_originals:
+                setattr(module, attr, _playcrypt_originals.pop((name, attr)))
+
+def use(new_source):
+    """
+    Makes new_source the source of every later draw. A seeded source also
+    takes over playcrypt's draws and seeds the random module.
+
+    :return: new_source
+    """
+    global source
+    source = new_source
+    seeded = getattr(new_source, "seeded", False)
+    route_playcrypt(seeded)
+    if seeded:
+        random.seed("%s" % new_source.seed)
+    return new_source
+
+def reseed(seed, stream=0):
+    source.reseed(seed, stream)
+
+def random_bytes(n):
+    return source.read(n)
+
+def random_string(n):
+    """
+    :param n: length in bytes
+    :return: a uniformly random string of n characters
+    """
+    return source.read(n).decode("latin-1")
+
+def random_Z_N_star(N):
+    """
+    :return: a uniformly random element of Z_N^*, by rejection sampling
+    """
+    bits = N.bit_length()
+    size = (bits + 7) // 8
+    mask = (1 << bits) - 1
+    while True:
+        x = int.from_bytes(source.read(size), "big") & mask
+        if 0 < x < N and math.gcd(x, N) == 1:
+            return x
@@ -0,0 +1,134 @@
+"""
+Parameter sweeps with an on-disk result cache
+"""
+
+import os, sys, json, random, hashlib, itertools
+import multiprocessing
+
+import instrument
+import randomness
+
+"""
+A sweep runs a cell function on every point of a parameter grid. A cell is a
+module-level function cell(params, seed) that returns a JSON-serializable
+result. Results are stored in SWEEP_CACHE, next to this module whatever
+the working directory, keyed by the parameters, the seed, and a hash of
+the code. The code hash covers the cell's own source file and every other
+module loaded from that directory, such as trial_runner or randomness. A rerun therefore computes only cells that are
+new or whose code changed. A cached result is replayed as it was, so a
+cell must not return timings or rates; scripts measure those outside the
+sweep.
+
+Cells that are not in the cache run in parallel, each in a forked worker.
+Before a cell runs, the random module and the randomness source are
+reseeded from the seed and the cell's parameters, so a cell computes the
+same result in any worker.
+A worker has its own copy of the script's globals, so a cell may rebind
+k_bytes, E and the rest through the script's configure() function without
+affecting cells running in other workers.
+
+Usage, in a script's __main__:
+
+    for (params, result) in sweep(sweep_cell, {"k": [128, 256], "n": [128]}):
+        print(params, result)
+"""
+
+SWEEP_CACHE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sweep_cache.json")
+
+def grid_cells(grid):
+    """
+    :param grid: a dict mapping each parameter to a list of values, expanded
+    to their product, or an iterable of parameter dicts taken as they are
+    :return: a list of parameter dicts
+    """
+    if isinstance(grid, dict):
+        names = sorted(grid)
+        return [dict(zip(names, values)) for values in itertools.product(*(grid[name] for name in names))]
+    return [dict(params) for params in grid]
+
+def code_hash(cell):
+    """
+    :return: hex SHA-256 of the source files of the modules loaded from the
+    directory that defines cell
+    """
+    directory = os.path.dirname(os.path.abspath(sys.modules[cell.__module__].__file__))
+    files = set()
+    for module in list(sys.modules.values()):
+        path = getattr(module, "__file__", None)
+        if path and path.endswith(".py") and os.path.dirname(os.path.abspath(path)) == directory:
+            files.add(os.path.abspath(path))
+    digest = hashlib.sha256()
+    for path in sorted(files):
+        digest.update(os.path.basename(path).encode())
+        with open(path, "rb") as f:
+            digest.update(hashlib.sha256(f.read()).digest())
+    return digest.hexdigest()
+
+def cell_key(cell, params, code, seed):
+    return hashlib.sha256(json.dumps([cell.__module__, cell.__name__, params, code, seed],
+                                     sort_keys=True).encode()).hexdigest()
+
+def load_cache(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+def save_cache(path, cache):
+    """
+    Writes the cache through a temporary file, so an interrupted run never
+    leaves a truncated one.
+    """
+    with open(path + ".tmp", "w") as f:
+        json.dump(cache, f, indent=1, sort_keys=True)
+    os.replace(path + ".tmp", path)
+
+_cell = None
+
+def _run_cell(args):
+    index, params, seed = args
+    cell_seed = "%s:%s" % (seed, json.dumps(params, sort_keys=True))
+    random.seed(cell_seed)
+    randomness.reseed(cell_seed)
+    # Round trip through JSON so fresh results look like cached ones.
+    result = json.loads(json.dumps(_cell(params, seed)))
+    return index, result, instrument.take()
+
+def sweep(cell, grid, seed=0, path=SWEEP_CACHE, processes=None):
+    """
+    Runs cell on every point of grid, reusing cached results.
+
+    :param cell: module-level function cell(params, seed) -> result
+    :param grid: parameter grid, see grid_cells
+    :param seed: seed handed to every cell and part of the cache key
+    :param path: cache file, or None to run without a cache
+    :param processes: number of worker processes, defaults to the core count
+    :return: a list of (params, result) in grid order
+    """
+    global _cell
+    cells = grid_cells(grid)
+    code = code_hash(cell)
+    keys = [cell_key(cell, params, code, seed) for params in cells]
+    cache = load_cache(path) if path else {}
+    results = [cache[key]["result"] if key in cache else None for key in keys]
+    todo = [(i, cells[i], seed) for i in range(len(cells)) if keys[i] not in cache]
+
+    processes = processes or os.cpu_count() or 1
+    if multiprocessing.current_process().daemon:
+        processes = 1
+    _cell = cell
+    pool = None
+    if processes > 1 and len(todo) > 1:
+        pool = multiprocessing.get_context("fork").Pool(min(processes, len(todo)))
+    try:
+        for (i, result, record) in (pool.imap_unordered(_run_cell, todo) if pool else map(_run_cell, todo)):
+            results[i] = result
+            instrument.merge(record)
+            if path:
+                cache[keys[i]] = {"params": cells[i], "seed": seed, "result": result}
+                save_cache(path, cache)
+    finally:
+        if pool:
+            pool.terminate()
+            pool.join()
+    return list(zip(cells, results))
@@ -0,0 +1,172 @@
+"""
+Monte-Carlo advantage estimation shared by the game scripts
+"""
+
+import os, random, math
+import randomness
+import instrument
+import multiprocessing
+from collections import namedtuple
+from statistics import NormalDist
+
+"""
+One trial is one call to sim.compute_advantage(1) on any of the playcrypt
+simulators (LRSim, KRSim, CRSim, CTXTSim, PKELRSim, UFCMASim). Its value
+lies in [-1, 1] and its expectation is the advantage, so the trials can be
+averaged and split across processes freely.
+
+Trials run in batches. Batch i seeds the random module and reseeds the
+current randomness source from (seed, i). In one process a seeded run
+therefore repeats exactly when its coins come from the source, that is,
+when a seeded CounterPRG is in use (see randomness). Over several processes
+the batches reach the workers in no fixed order, so games sharing a lazily
+sampled ideal primitive can see different values, and only the
+distribution of the estimate is fixed.
+"""
+
+class Estimate(namedtuple("Estimate", "advantage low high trials")):
+    def __str__(self):
+        return "%.4f [%.4f, %.4f] over %d trials" % self
+
+_sim = None
+
+def _run_batch(args):
+    """
+    :param args: (seed, batch index, number of trials)
+    :return: (sum of the trial values, sum of their squares, number of trials,
+    instrument recordings or None)
+    """
+    seed, index, size = args
+    random.seed("%s:%d" % (seed, index))
+    randomness.reseed(seed, index)
+    total = 0.0
+    squares = 0.0
+    for i in range(size):
+        x = _sim.compute_advantage(1)
+        total += x
+        squares += x * x
+    return (total, squares, size, instrument.take())
+
+def _estimate(total, squares, count, z):
+    """
+    Wilson-style score interval on the trial values rescaled from [-1, 1] to
+    [0, 1], using their sample variance. For 0/1 trials this is the Wilson
+    interval, and unlike the plain normal interval it does not collapse to a
+    point when every trial agrees.
+    """
+    p = (total / count + 1) / 2
+    variance = max((squares / count - (total / count) ** 2) / 4, 0.0)
+    centre = (p + z * z / (2 * count)) / (1 + z * z / count)
+    half = z / (1 + z * z / count) * math.sqrt(variance / count + z * z / (4 * count * count))
+    return Estimate(total / count, max(2 * (centre - half) - 1, -1.0), min(2 * (centre + half) - 1, 1.0), count)
+
+def _rounds(sim, trials, limit, processes, seed, batch_size):
+    """
+    Runs rounds of trials, the first of the given size and each later one as
+    large as everything before it (capped so no more than limit trials run in
+    total), and yields the running (sum, sum of squares, count) after every
+    round.
+    """
+    global _sim
+    processes = processes or os.cpu_count() or 1
+    if multiprocessing.current_process().daemon:
+        processes = 1
+    if seed is None:
+        seed = int.from_bytes(randomness.random_bytes(8), "big")
+    _sim = sim
+
+    pool = None
+    if processes > 1:
+        pool = multiprocessing.get_context("fork").Pool(processes)
+    size = batch_size or max(1, trials // 64)
+    total, squares, count, index = 0.0, 0.0, 0, 0
+    try:
+        todo = trials
+        while True:
+            tasks = []
+            while todo > 0:
+                tasks.append((seed, index, min(size, todo)))
+                todo -= size
+                index += 1
+            results = pool.imap_unordered(_run_batch, tasks) if pool else map(_run_batch, tasks)
+            for (t, q, c, record) in results:
+                total, squares, count = total + t, squares + q, count + c
+                instrument.merge(record)
+            yield (total, squares, count)
+            todo = min(count, limit - count)
+    finally:
+        if pool:
+            pool.terminate()
+            pool.join()
+
+def run_trials(sim, trials=1000, processes=None, seed=None, epsilon=None,
+               confidence=0.95, batch_size=None, max_trials=10**6):
+    """
+    Estimates the advantage of the adversary in sim, in parallel.
+
+    :param sim: a playcrypt simulator wrapping a game and an adversary
+    :param trials: number of trials, or the first round when epsilon is set
+    :param processes: number of worker processes, defaults to the core count
+    :param seed: seeds the batches, see above; drawn from the current
+    randomness source if None
+    :param epsilon: if set, keep running rounds of trials until the
+    confidence interval is narrower than epsilon or max_trials is reached
+    :param confidence: confidence level of the interval
+    :param batch_size: trials per task handed to a worker, 1/64 of the trials
+    by default
+    :param max_trials: cap on the number of trials when epsilon is set
+    :return: Estimate(advantage, low, high, trials)
+    """
+    z = NormalDist().inv_cdf((1 + confidence) / 2)
+    for (total, squares, count) in _rounds(sim, trials, max_trials, processes, seed, batch_size):
+        estimate = _estimate(total, squares, count, z)
+        if epsilon is None or estimate.high - estimate.low < epsilon or count >= max_trials:
+            return estimate
+
+"""
+Sequential estimation. Adversaries in these scripts usually have advantage
+close to 1 or to 0, where the trials barely vary. The empirical Bernstein
+bound (Maurer and Pontil) shrinks with the sample variance, so it brackets
+such an advantage after a few hundred trials, where a fixed count or a
+Hoeffding bound would run them all. The bound is checked after every round
+of a doubling schedule, and round j is given confidence delta / 2^(j+1) so
+the stopping rule holds with probability 1 - delta overall.
+"""
+
+def _bernstein(total, squares, count, delta):
+    """
+    Two-sided empirical Bernstein interval for trial values in [-1, 1].
+    """
+    mean = total / count
+    variance = max(squares / count - mean * mean, 0.0) * count / max(count - 1, 1)
+    log = math.log(4 / delta)
+    half = math.sqrt(2 * variance * log / count) + 7 * 2 * log / (3 * max(count - 1, 1))
+    return Estimate(mean, max(mean - half, -1.0), min(mean + half, 1.0), count)
+
+def sequential_advantage(sim, epsilon=0.1, delta=0.05, trials=1000, first=32,
+                         processes=None, seed=None, batch_size=None):
+    """
+    Estimates the advantage of the adversary in sim, stopping as soon as it
+    is bracketed to within plus or minus epsilon.
+
+    :param sim: a playcrypt simulator wrapping a game and an adversary
+    :param epsilon: stop once the interval reaches no further than this from
+    the estimate on either side
+    :param delta: probability that the final interval misses the advantage
+    :param trials: the fixed trial count being replaced, and the most trials
+    that are run
+    :param first: size of the first round of trials
+    :param processes: number of worker processes, defaults to the core count
+    :param seed: seeds the batches, see above; drawn from the current
+    randomness source if None
+    :param batch_size: trials per task handed to a worker
+    :return: (Estimate(advantage, low, high, trials), number of trials saved
+    compared to running all of them)
+    """
+    first = min(first, trials)
+    rounds = _rounds(sim, first, trials, processes, seed, batch_size or max(1, first // 4))
+    for (j, (total, squares, count)) in enumerate(rounds):
+        estimate = _bernstein(total, squares, count, delta / 2 ** (j + 1))
+        if max(estimate.high - estimate.advantage, estimate.advantage - estimate.low) <= epsilon or count >= trials:
+            rounds.close()
+            return estimate, trials - count